@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import argparse
+import collections
 import glob
+import hashlib
 import inspect
+import json
 import os
 import settings
 import sys
@@ -10,7 +14,9 @@ import urllib
 
 import kpov_util
 import pymongo
+import task_manifest
 from bson import Binary
+from pymongo import DeleteMany, UpdateMany, UpdateOne
 
 def task_check(results, params):
     data = {
@@ -37,92 +43,175 @@ def gen_params(user_id, meta):
 dummy_gen_params_source = inspect.getsource(gen_params)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: {0} <task_dir> [task_name]".format(sys.argv[0]))
-        exit(1)
-    dirname = sys.argv[1]
-    fname = os.path.join(dirname, 'task.py')
-    try:
-        course_id, task_id = sys.argv[2].split('/')
-    except:
-        normpath = os.path.normpath(dirname)
-        course_id = os.path.split(os.path.dirname(normpath))[-1]
-        task_id = os.path.basename(normpath)
-    print((course_id, task_id))
-
-    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
-
-    source = open(fname).read()
-    d = {}
-    # defines task, task_check, gen_params, prepare_disks, computers, params_meta
-    exec(compile(source, fname, 'exec'), globals(), d)
+def load_task(dirname):
+    # read everything that is uploaded for the task in dirname
+    manifest = task_manifest.load(os.path.join(dirname, 'task.py'), globals=globals())
+    # computers, params_meta, instructions and optionally networks
+    d = manifest['values']
+    # sources of task, task_check, gen_params and prepare_disks
+    functions = manifest['functions']
 
     public_meta = {}
     for k, v in d['params_meta'].items():
         if v.get('public', False):
             public_meta[k] = v
     task_source = "\n\n".join([
-        inspect.getsource(d['task']),
+        functions['task'],
         uploading_task_check_source,
         "params_meta = {}".format(public_meta),
         dummy_gen_params_source])
-    task_check_source = inspect.getsource(d['task_check'])
-    gen_params_source = inspect.getsource(d['gen_params'])
-    prepare_disks_source = inspect.getsource(d['prepare_disks'])
     x = list(d['params_meta'].keys()) # check for existence
-    db.computers_meta.remove({'task_id': task_id, 'course_id': course_id})
+
     auto_networks = set([None])
     for k, v in d['computers'].items():
         for n in v.get('network_interfaces', []):
             auto_networks.add(n.get('network', None))
-        db.computers_meta.update({
-                'task_id': task_id,
-                'course_id': course_id, 
-                'name': k
-            }, {'$set': v}, upsert=True)
     auto_networks.remove(None)
-    db.networks.remove({'task_id': task_id, 'course_id': course_id})
-    db.task_params.remove({'task_id': task_id, 'course_id': course_id})
-    db.student_computers.remove({'task_id': task_id, 'course_id': course_id})
-    db.prepare_disks.remove({'task_id': task_id, 'course_id': course_id})
     try:
-        net_list = d['networks'].items()
+        net_list = list(d['networks'].items())
     except:
-        net_list = [(k, {'public': False}) for k in auto_networks]
-    for k, v in net_list:
-        db.networks.update({'task_id': task_id, 'course_id': course_id, 'name': k}, {'$set': v}, upsert=True)
-    db.task_checkers.update({
-            'task_id': task_id, 'course_id': course_id
-        }, {'$set': {'source': task_check_source}}, upsert=True)
-    db.tasks.update({
-            'task_id': task_id, 'course_id': course_id
-        },{'$set': {'source': task_source}}, upsert=True)
-    db.prepare_disks.update({
-            'task_id': task_id, 'course_id': course_id
-        }, {'$set': {'source': prepare_disks_source}}, upsert=True)
-    db.gen_params.update({'task_id': task_id, 'course_id': course_id},
-        {'$set': {'source': gen_params_source}}, upsert=True)
-    db.task_params_meta.update({'task_id': task_id, 'course_id': course_id},
-        {'$set': {'params': d['params_meta']}}, upsert=True)
-    db.task_instructions.update({'task_id': task_id, 'course_id': course_id}, 
-        {'$set': d['instructions']}, upsert=True)
+        # sorted, so the networks component hashes the same on every run
+        net_list = [(k, {'public': False}) for k in sorted(auto_networks)]
+
+    howtos = {}
+    howto_images = {}
     for howto_dir in glob.glob(os.path.join(dirname, 'howtos/*')):
         howto_lang = os.path.basename(os.path.normpath(howto_dir))
         if howto_lang not in {'images'}:
             with open(os.path.join(howto_dir, 'index.html')) as f:
-                db.howtos.update({
-                        'task_id': task_id,
-                        'course_id': course_id,
-                        'lang': howto_lang},
-                    {'$set': {'text': f.read()}}, upsert=True)
+                howtos[howto_lang] = f.read()
         else:
             for img in glob.glob(os.path.join(howto_dir, '*')):
-                fname = os.path.basename(img)
                 with open(img, 'rb') as f:
-                    db.howto_images.update({
-                            'task_id': task_id,
-                            'course_id': course_id,
-                            'fname': fname,
-                        },
-                        {'$set': {'data': Binary(f.read())}}, upsert=True)
+                    howto_images[os.path.basename(img)] = f.read()
+
+    return {
+        'task_source': task_source,
+        'task_check_source': functions['task_check'],
+        'memoize_checks': bool(d.get('memoize_checks', True)),
+        'gen_params_source': functions['gen_params'],
+        'prepare_disks_source': functions['prepare_disks'],
+        'params_meta': d['params_meta'],
+        'computers': d['computers'],
+        'networks': net_list,
+        'instructions': d['instructions'],
+        'howtos': howtos,
+        'howto_images': howto_images,
+    }
+
+# uploaded components and the task fields they are built from
+components = {
+    'task': ['task_source'],
+    'task_check': ['task_check_source', 'memoize_checks'],
+    'gen_params': ['gen_params_source'],
+    'prepare_disks': ['prepare_disks_source'],
+    'params_meta': ['params_meta'],
+    'computers': ['computers'],
+    'networks': ['networks'],
+    'instructions': ['instructions'],
+    'howtos': ['howtos', 'howto_images'],
+}
+
+def component_hashes(task):
+    hashes = {}
+    for component, fields in components.items():
+        h = hashlib.sha256()
+        for field in fields:
+            value = task[field]
+            if field == 'howto_images':
+                for fname in sorted(value):
+                    h.update(fname.encode() + b'\0' + hashlib.sha256(value[fname]).digest())
+            elif isinstance(value, str):
+                h.update(value.encode())
+            else:
+                h.update(json.dumps(value, sort_keys=True, default=str).encode())
+            h.update(b'\0')
+        hashes[component] = h.hexdigest()
+    return hashes
+
+def changed_components(task, stored_hashes=None):
+    hashes = component_hashes(task)
+    if stored_hashes is None:
+        return hashes, set(hashes)
+    return hashes, {c for c, h in hashes.items() if stored_hashes.get(c) != h}
+
+def get_stored_hashes(db, course_id, task_id):
+    record = db.task_hashes.find_one({'course_id': course_id, 'task_id': task_id})
+    return record['hashes'] if record else None
+
+def task_requests(course_id, task_id, task, stored_hashes=None):
+    # bulk write requests for each collection that update the stored task;
+    # only changed components are written, and only the student state
+    # depending on them is reset
+    key = {'task_id': task_id, 'course_id': course_id}
+    hashes, changed = changed_components(task, stored_hashes)
+    requests = collections.defaultdict(list)
+    if not changed:
+        return requests, changed
+
+    if 'computers' in changed:
+        requests['computers_meta'].append(DeleteMany(key))
+        for k, v in task['computers'].items():
+            requests['computers_meta'].append(UpdateOne(dict(key, name=k), {'$set': v}, upsert=True))
+    if 'networks' in changed:
+        requests['networks'].append(DeleteMany(key))
+        for k, v in task['networks']:
+            requests['networks'].append(UpdateOne(dict(key, name=k), {'$set': v}, upsert=True))
+    if changed & {'gen_params', 'params_meta', 'computers'}:
+        # student params and computers are recreated on the next visit;
+        # submission tokens stay valid
+        requests['task_params'].append(UpdateMany(key, {'$unset': {'params': ''}}))
+        requests['student_computers'].append(DeleteMany(key))
+    elif 'prepare_disks' in changed:
+        # keep the params, just build the disks again
+        requests['student_computers'].append(UpdateMany(key, {'$unset': {'disk_urls': ''}}))
+    if 'prepare_disks' in changed:
+        requests['prepare_disks'].append(UpdateOne(key, {'$set': {'source': task['prepare_disks_source']}}, upsert=True))
+    if 'task_check' in changed:
+        requests['task_checkers'].append(UpdateOne(key, {'$set': {
+            'source': task['task_check_source'], 'memoize': task['memoize_checks']}}, upsert=True))
+    if 'task' in changed:
+        requests['tasks'].append(UpdateOne(key, {'$set': {'source': task['task_source']}}, upsert=True))
+    if 'gen_params' in changed:
+        requests['gen_params'].append(UpdateOne(key, {'$set': {'source': task['gen_params_source']}}, upsert=True))
+    if 'params_meta' in changed:
+        requests['task_params_meta'].append(UpdateOne(key, {'$set': {'params': task['params_meta']}}, upsert=True))
+    if 'instructions' in changed:
+        requests['task_instructions'].append(UpdateOne(key, {'$set': task['instructions']}, upsert=True))
+    if 'howtos' in changed:
+        requests['howtos'].append(DeleteMany(dict(key, lang={'$nin': list(task['howtos'])})))
+        for lang, text in task['howtos'].items():
+            requests['howtos'].append(UpdateOne(dict(key, lang=lang), {'$set': {'text': text}}, upsert=True))
+        requests['howto_images'].append(DeleteMany(dict(key, fname={'$nin': list(task['howto_images'])})))
+        for fname, data in task['howto_images'].items():
+            requests['howto_images'].append(UpdateOne(dict(key, fname=fname), {'$set': {'data': Binary(data)}}, upsert=True))
+    requests['task_hashes'].append(UpdateOne(key, {'$set': {'hashes': hashes}}, upsert=True))
+    return requests, changed
+
+def upload_task(db, course_id, task_id, task, force=False):
+    stored_hashes = None if force else get_stored_hashes(db, course_id, task_id)
+    requests, changed = task_requests(course_id, task_id, task, stored_hashes)
+    for collection, reqs in requests.items():
+        db[collection].bulk_write(reqs)
+    return changed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Upload a task to the database.')
+    argparser.add_argument('task_dir')
+    argparser.add_argument('task_name', nargs='?', help='course_id/task_id')
+    argparser.add_argument('-f', '--force', action='store_true',
+        help='rewrite all components even if unchanged')
+    args = argparser.parse_args()
+    dirname = args.task_dir
+    try:
+        course_id, task_id = args.task_name.split('/')
+    except:
+        normpath = os.path.normpath(dirname)
+        course_id = os.path.split(os.path.dirname(normpath))[-1]
+        task_id = os.path.basename(normpath)
+    print((course_id, task_id))
+
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    changed = upload_task(db, course_id, task_id, load_task(dirname), force=args.force)
+    print('changed: {}'.format(', '.join(sorted(changed)) if changed else 'nothing'))
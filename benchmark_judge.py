@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Load test for the judge web app. A synthetic course is written to a MongoDB
+# database (or to mongomock with --in-memory), then the task page,
+# params.json, results.json, setup.svg and howto images are requested from
+# several threads, and the latency percentiles and throughput of each
+# endpoint are reported. With --compare REV the same benchmark is run with
+# the web app of git revision REV and of the working tree.
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+COURSE_ID = 'bench'
+
+CHECKER_SOURCE = '''def task_check(results, params):
+    hints = []
+    score = 0
+    for line in results['output'].splitlines():
+        if params['IP'] in line:
+            score += 1
+    if results['name'] != params['NAME']:
+        hints.append('wrong name')
+    return min(score, 10), hints
+'''
+
+GEN_PARAMS_SOURCE = '''def gen_params(user_id, params_meta):
+    r = random.Random(user_id)
+    return {'IP': '10.0.{}.{}'.format(r.randint(0, 255), r.randint(1, 254)),
+            'NAME': 'host{}'.format(r.randint(0, 999)),
+            'SECRET': str(r.random())}
+'''
+
+PARAMS_META = {
+    'IP': {'public': True, 'descriptions': {'en': 'Address', 'si': 'Naslov'}},
+    'NAME': {'public': True, 'w': True, 'descriptions': {'en': 'Name', 'si': 'Ime'}},
+    'SECRET': {'public': False},
+}
+
+# relative frequency of each request in the mix
+DEFAULT_MIX = {'greeting': 2, 'params': 3, 'results': 3, 'setup': 1, 'image': 1}
+
+def student_id(i):
+    return 'student{:04d}'.format(i)
+
+def task_id(i):
+    return 'task{:02d}'.format(i)
+
+def token(student, task):
+    return 'token-{}-{}'.format(student, task)
+
+def gen_params(student):
+    d = {'random': random}
+    exec(GEN_PARAMS_SOURCE, d)
+    return d['gen_params'](student, PARAMS_META)
+
+def command_output(r, lines, params):
+    out = []
+    for i in range(lines):
+        ip = params['IP'] if r.random() < 0.1 else '192.168.{}.{}'.format(r.randint(0, 255), r.randint(1, 254))
+        out.append('{:5d} {} {:.3f} ms'.format(i, ip, r.random() * 10))
+    return '\n'.join(out)
+
+def seed(db, n_tasks=10, n_students=200, n_results=10, n_images=3, image_size=50000,
+         instructions_size=20000, rng_seed=0):
+    r = random.Random(rng_seed)
+    for collection in ['courses', 'tasks', 'task_checkers', 'gen_params', 'task_params_meta',
+                       'task_instructions', 'computers_meta', 'networks', 'howtos', 'howto_images',
+                       'task_params', 'student_computers', 'results', 'student_tasks']:
+        db[collection].delete_many({'course_id': COURSE_ID})
+    db.courses.insert_one({'course_id': COURSE_ID, 'name': 'Benchmark'})
+    paragraph = '<p>Set the address of {{IP}} on the computer called {{NAME}}. </p>\n'
+    instructions = paragraph * (instructions_size // len(paragraph) + 1)
+    params = {s: gen_params(student_id(s)) for s in range(n_students)}
+    start = datetime.datetime(2020, 1, 1)
+    for t in range(n_tasks):
+        key = {'course_id': COURSE_ID, 'task_id': task_id(t)}
+        db.tasks.insert_one(dict(key, source='def task():\n    return {}\n'))
+        db.task_checkers.insert_one(dict(key, source=CHECKER_SOURCE))
+        db.gen_params.insert_one(dict(key, source=GEN_PARAMS_SOURCE))
+        db.task_params_meta.insert_one(dict(key, params=PARAMS_META))
+        db.task_instructions.insert_one(dict(key, en=instructions, si=instructions))
+        db.networks.insert_many([dict(key, name='net1', public=True), dict(key, name='net2')])
+        db.computers_meta.insert_many([
+            dict(key, name='SimpleArbiter', disks=[{'name': 'simpleArbiterDhcp'}],
+                 network_interfaces=[{'network': 'net1'}, {'network': 'net2'}]),
+            dict(key, name='Student', disks=[{'name': 'student'}, {'name': 'data'}],
+                 network_interfaces=[{'network': 'net2'}]),
+        ])
+        db.howtos.insert_one(dict(key, lang='en', text=instructions))
+        db.howto_images.insert_many([
+            dict(key, fname='image{}.png'.format(i), data=r.getrandbits(8 * image_size).to_bytes(image_size, 'little'))
+            for i in range(n_images)])
+        task_params = []
+        computers = []
+        results = []
+        for s in range(n_students):
+            student = student_id(s)
+            task_params.append(dict(key, student_id=student, params=params[s], token=token(student, task_id(t))))
+            for name in ['SimpleArbiter', 'Student']:
+                computers.append(dict(key, student_id=student, name=name, disk_urls={
+                    name.lower(): {'formats': ['qcow2'], 'qcow2': [name.lower() + '.qcow2', 'base.qcow2']}}))
+            for i in range(n_results):
+                output = command_output(r, r.randint(10, 200), params[s])
+                results.append(dict(key, student_id=student, result=r.randint(0, 10), hints=['wrong name'] * r.randint(0, 1),
+                                    status='OK', response={'output': output, 'name': params[s]['NAME']},
+                                    time=start + datetime.timedelta(minutes=s * n_results + i)))
+        db.task_params.insert_many(task_params)
+        db.student_computers.insert_many(computers)
+        if results:
+            db.results.insert_many(results)
+
+class AppClient:
+    # requests to the app in this process through the Flask test client
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def fetch(self, method, path, student, data=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=data, environ_base={'REMOTE_USER': student})
+        return response.status_code, response.get_data()
+
+    def request(self, *args, **kwargs):
+        return self.fetch(*args, **kwargs)[0]
+
+class HttpClient:
+    # requests to a running server; REMOTE_USER is whatever the server sets
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def fetch(self, method, path, student, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def request(self, *args, **kwargs):
+        return self.fetch(*args, **kwargs)[0]
+
+def make_request(kind, r, n_tasks, n_students, n_images):
+    # (method, path, student, data) of a random request of the given kind
+    student = student_id(r.randrange(n_students))
+    task = task_id(r.randrange(n_tasks))
+    base = '/tasks/{}/{}'.format(COURSE_ID, task)
+    if kind == 'greeting':
+        return 'GET', base + '/en/', student, None
+    if kind == 'params':
+        return 'POST', base + '/params.json', student, {'token': token(student, task)}
+    if kind == 'results':
+        params = gen_params(student)
+        results = {'output': command_output(r, r.randint(10, 200), params), 'name': params['NAME']}
+        return 'POST', base + '/results.json', student, {
+            'token': token(student, task), 'results': json.dumps(results), 'params': json.dumps({})}
+    if kind == 'setup':
+        return 'GET', base + '/en/setup.svg', student, None
+    if kind == 'image':
+        return 'GET', base + '/en/images/image{}.png'.format(r.randrange(n_images)), student, None
+    raise ValueError(kind)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def run(client, n_requests, concurrency, mix, n_tasks, n_students, n_images, rng_seed=1, warmup=20):
+    r = random.Random(rng_seed)
+    kinds = [k for k in mix if mix[k] > 0]
+    weights = [mix[k] for k in kinds]
+    requests = [r.choices(kinds, weights)[0] for _ in range(n_requests)]
+    # build the requests beforehand, so only the app is timed
+    requests = [(kind, make_request(kind, r, n_tasks, n_students, n_images)) for kind in requests]
+    for kind, req in requests[:warmup]:
+        client.request(*req)
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    def timed(job):
+        kind, req = job
+        start = time.perf_counter()
+        try:
+            status = client.request(*req)
+        except Exception:
+            status = 'exception'
+        return kind, time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for kind, seconds, status in executor.map(timed, requests):
+            latencies[kind].append(seconds)
+            if status != 200:
+                errors[kind] += 1
+    elapsed = time.perf_counter() - start
+
+    report = {'requests': n_requests, 'concurrency': concurrency, 'seconds': elapsed,
+              'throughput': n_requests / elapsed, 'endpoints': {}}
+    for kind in kinds:
+        values = sorted(latencies[kind])
+        report['endpoints'][kind] = {
+            'requests': len(values),
+            'errors': errors[kind],
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'throughput': len(values) / elapsed,
+        }
+    return report
+
+def print_report(report, out=sys.stdout):
+    print('{:<10} {:>8} {:>7} {:>10} {:>10} {:>10} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'), file=out)
+    for kind, e in report['endpoints'].items():
+        print('{:<10} {:>8} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>8.1f}'.format(
+            kind, e['requests'], e['errors'], e['p50'] * 1000, e['p95'] * 1000, e['p99'] * 1000, e['throughput']), file=out)
+    print('total {:.1f} req/s with {} threads'.format(report['throughput'], report['concurrency']), file=out)
+
+def print_comparison(reports, out=sys.stdout):
+    (name_a, a), (name_b, b) = reports
+    print('{:<10} {:>6} {:>10} {:>10} {:>8}'.format('endpoint', '', name_a[:10], name_b[:10], 'change'), file=out)
+    for kind in a['endpoints']:
+        for stat in ['p50', 'p95', 'p99']:
+            va = a['endpoints'][kind][stat] * 1000
+            vb = b['endpoints'][kind][stat] * 1000
+            print('{:<10} {:>6} {:>10.2f} {:>10.2f} {:>+7.1f}%'.format(
+                kind, stat, va, vb, (vb - va) / va * 100 if va else 0), file=out)
+    print('{:<10} {:>6} {:>10.1f} {:>10.1f} {:>+7.1f}%'.format(
+        'total', 'req/s', a['throughput'], b['throughput'],
+        (b['throughput'] - a['throughput']) / a['throughput'] * 100), file=out)
+
+def load_app(app_dir, db_uri, in_memory):
+    # import kpov_judge from app_dir with settings for the benchmark database
+    settings_dir = tempfile.mkdtemp(prefix='kpov-bench-')
+    with open(os.path.join(settings_dir, 'settings.py'), 'w') as f:
+        f.write('DEBUG = False\nDEFAULT_LANG = "en"\nDB_URI = {!r}\n'
+                'STUDENT_DISK_URL = "http://localhost/disks"\nSTATIC_DIR = {!r}\n'.format(
+                    db_uri, os.path.join(app_dir, 'static')))
+    sys.path[:0] = [settings_dir, app_dir]
+    if in_memory:
+        # one shared in-memory server for the seeding and every request
+        import mongomock
+        import pymongo
+        client = mongomock.MongoClient(db_uri)
+        pymongo.MongoClient = lambda *args, **kwargs: client
+    import kpov_judge
+    return kpov_judge.app
+
+def get_db(db_uri):
+    # with --in-memory, load_app has already replaced the client
+    import pymongo
+    return pymongo.MongoClient(db_uri).get_default_database()
+
+def compare(args):
+    # run this script once for each revision, in separate processes
+    repo = os.path.dirname(os.path.abspath(__file__))
+    worktree = tempfile.mkdtemp(prefix='kpov-bench-{}-'.format(args.compare))
+    subprocess.check_call(['git', '-C', repo, 'worktree', 'add', '--detach', worktree, args.compare])
+    reports = []
+    try:
+        for name, app_dir in [(args.compare, os.path.join(worktree, 'web', 'kpov_judge')),
+                              ('working tree', os.path.join(repo, 'web', 'kpov_judge'))]:
+            output = os.path.join(worktree, 'report.json')
+            argv = [sys.executable, os.path.abspath(__file__), '--app-dir', app_dir, '--output', output, '-q',
+                    '--db-uri', args.db_uri, '--tasks', str(args.tasks), '--students', str(args.students),
+                    '--results', str(args.results), '--images', str(args.images),
+                    '--image-size', str(args.image_size), '--requests', str(args.requests),
+                    '--concurrency', str(args.concurrency), '--mix', args.mix]
+            if args.in_memory:
+                argv.append('--in-memory')
+            print('running {}'.format(name), file=sys.stderr)
+            subprocess.check_call(argv)
+            with open(output) as f:
+                reports.append((name, json.load(f)))
+    finally:
+        subprocess.call(['git', '-C', repo, 'worktree', 'remove', '--force', worktree])
+        shutil.rmtree(worktree, ignore_errors=True)
+    print_comparison(reports)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark the judge web app on a synthetic course.')
+    argparser.add_argument('--db-uri', default='mongodb://localhost:27017/kpov_bench',
+        help='database to seed; everything in the course "bench" is replaced')
+    argparser.add_argument('--in-memory', action='store_true', help='use mongomock instead of a mongod')
+    argparser.add_argument('--url', help='benchmark a running server at this URL instead of importing the app')
+    argparser.add_argument('--app-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web', 'kpov_judge'))
+    argparser.add_argument('--no-seed', action='store_true', help='use the data already in the database')
+    argparser.add_argument('-t', '--tasks', type=int, default=10)
+    argparser.add_argument('-s', '--students', type=int, default=200)
+    argparser.add_argument('-r', '--results', type=int, default=10, help='stored results per student and task')
+    argparser.add_argument('--images', type=int, default=3, help='howto images per task')
+    argparser.add_argument('--image-size', type=int, default=50000)
+    argparser.add_argument('-n', '--requests', type=int, default=2000)
+    argparser.add_argument('-c', '--concurrency', type=int, default=8)
+    argparser.add_argument('--mix', default=','.join('{}={}'.format(k, v) for k, v in DEFAULT_MIX.items()),
+        help='relative frequency of each request kind')
+    argparser.add_argument('--compare', metavar='REV', help='also run the app of this git revision and compare')
+    argparser.add_argument('-o', '--output', help='write the report as JSON')
+    argparser.add_argument('-q', '--quiet', action='store_true')
+    args = argparser.parse_args()
+
+    if args.url and (args.in_memory or args.compare):
+        argparser.error('--url cannot be used with --in-memory or --compare')
+    if args.compare:
+        compare(args)
+        sys.exit(0)
+
+    mix = {k: float(v) for k, v in (i.split('=') for i in args.mix.split(','))}
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        client = AppClient(load_app(args.app_dir, args.db_uri, args.in_memory))
+    if not args.no_seed:
+        start = time.perf_counter()
+        seed(get_db(args.db_uri), n_tasks=args.tasks, n_students=args.students,
+             n_results=args.results, n_images=args.images, image_size=args.image_size)
+        if not args.quiet:
+            print('seeded in {:.1f} s'.format(time.perf_counter() - start), file=sys.stderr)
+    report = run(client, args.requests, args.concurrency, mix, args.tasks, args.students, args.images)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not args.quiet:
+        print_report(report)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Shrink the results collection: compress the stored responses and hints,
+# and move old attempts out of it. For each student and task the best and the
+# last few attempts stay in results; the others are moved to the
+# results_archive collection (compressed) or appended to a gzipped file.
+
+import argparse
+import gzip
+import itertools
+import sys
+import time
+
+import pymongo
+from bson import json_util
+from pymongo import DeleteMany, ReplaceOne
+
+import settings
+from result_storage import pack, unpack
+
+def batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def repack_results(db, query, method, batch_size=500, dry_run=False, out=sys.stdout):
+    # compress results stored as plain documents, or with method=None
+    # restore compressed ones
+    if method:
+        query = dict(query, packed={'$exists': False})
+    else:
+        query = dict(query, packed={'$exists': True})
+    count = 0
+    start = time.perf_counter()
+    cursor = db.results.find(query, no_cursor_timeout=True, batch_size=batch_size)
+    try:
+        for batch in batches(cursor, batch_size):
+            count += len(batch)
+            if not dry_run:
+                db.results.bulk_write(
+                    [ReplaceOne({'_id': doc['_id']}, pack(unpack(doc), method)) for doc in batch],
+                    ordered=False)
+            print('{} results {:.1f}/s'.format(count, count / (time.perf_counter() - start)), file=sys.stderr)
+    finally:
+        cursor.close()
+    print('{} {} results'.format('compressed' if method else 'decompressed', count), file=out)
+    return count
+
+def _score(doc):
+    # same order as the best result shown on the task page
+    res = doc.get('result')
+    if isinstance(res, (int, float)):
+        return (-res, doc.get('time'))
+    return (float('inf'), doc.get('time'))
+
+def attempts_to_archive(db, query, keep_last):
+    # ids of all but the best and the last keep_last current attempts of each
+    # student; results superseded by a regraded version are always archived
+    fields = {'course_id': 1, 'task_id': 1, 'student_id': 1, 'result': 1, 'time': 1, 'superseded_by': 1}
+    order = [('course_id', 1), ('task_id', 1), ('student_id', 1), ('time', -1)]
+    cursor = db.results.find(query, fields, no_cursor_timeout=True).sort(order)
+    try:
+        for key, group in itertools.groupby(cursor, lambda d: (d['course_id'], d['task_id'], d['student_id'])):
+            group = list(group)
+            current = [d for d in group if 'superseded_by' not in d]
+            keep = {d['_id'] for d in current[:keep_last]}
+            if current:
+                keep.add(min(current, key=_score)['_id'])
+            for d in group:
+                if d['_id'] not in keep:
+                    yield d['_id']
+    finally:
+        cursor.close()
+
+def archived_ids(archive_file):
+    # ids already in the archive file, so that a run repeated after an
+    # interruption does not append them again
+    ids = set()
+    try:
+        with gzip.open(archive_file, 'rt') as f:
+            for line in f:
+                try:
+                    ids.add(json_util.loads(line)['_id'])
+                except (ValueError, KeyError):
+                    # the last line of an interrupted run may be incomplete
+                    pass
+    except FileNotFoundError:
+        pass
+    except EOFError:
+        # the gzip stream of an interrupted run may be truncated
+        pass
+    return ids
+
+def archive_results(db, query, keep_last, archive_file=None, method='zlib',
+                    batch_size=500, dry_run=False, out=sys.stdout):
+    db.results.create_index([('course_id', 1), ('task_id', 1), ('student_id', 1), ('time', -1)])
+    f = None
+    if archive_file and not dry_run:
+        seen = archived_ids(archive_file)
+        f = gzip.open(archive_file, 'at')
+    count = 0
+    try:
+        for ids in batches(attempts_to_archive(db, query, keep_last), batch_size):
+            count += len(ids)
+            if dry_run:
+                continue
+            docs = list(db.results.find({'_id': {'$in': ids}}))
+            # write the archive first, so an interrupted run loses nothing;
+            # running again skips or replaces what was already archived
+            if f:
+                for doc in docs:
+                    if doc['_id'] not in seen:
+                        f.write(json_util.dumps(unpack(doc)) + '\n')
+                f.flush()
+            else:
+                db.results_archive.bulk_write(
+                    [ReplaceOne({'_id': doc['_id']}, pack(unpack(doc), method or 'zlib'), upsert=True) for doc in docs],
+                    ordered=False)
+            db.results.bulk_write([DeleteMany({'_id': {'$in': ids}})])
+            print('archived {} results'.format(count), file=sys.stderr)
+    finally:
+        if f:
+            f.close()
+    print('{} {} results'.format('would archive' if dry_run else 'archived', count), file=out)
+    return count
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Compress and archive stored results.')
+    argparser.add_argument('task', nargs='?', help='course_id or course_id/task_id (default: all)')
+    argparser.add_argument('-c', '--compress', action='store_true',
+        help='compress existing results with RESULTS_COMPRESSION (default zlib)')
+    argparser.add_argument('-d', '--decompress', action='store_true',
+        help='store existing results uncompressed again')
+    argparser.add_argument('-a', '--archive', action='store_true',
+        help='move all but the best and the last attempts of each student out of results')
+    argparser.add_argument('-k', '--keep-last', type=int,
+        default=getattr(settings, 'RESULTS_KEEP_LAST', 5),
+        help='number of recent attempts kept in results')
+    argparser.add_argument('-o', '--archive-file',
+        help='append archived results to this gzipped JSON lines file instead of results_archive '
+             '(results already in the file are not appended again)')
+    argparser.add_argument('-n', '--dry-run', action='store_true')
+    argparser.add_argument('-b', '--batch-size', type=int, default=500)
+    args = argparser.parse_args()
+    if not (args.compress or args.decompress or args.archive) or (args.compress and args.decompress):
+        argparser.error('give --compress, --decompress and/or --archive')
+
+    query = {}
+    if args.task:
+        query['course_id'], _, task_id = args.task.partition('/')
+        if task_id:
+            query['task_id'] = task_id
+    method = getattr(settings, 'RESULTS_COMPRESSION', None) or 'zlib'
+
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    if args.archive:
+        archive_results(db, query, args.keep_last, archive_file=args.archive_file, method=method,
+                        batch_size=args.batch_size, dry_run=args.dry_run)
+    if args.compress or args.decompress:
+        repack_results(db, query, method if args.compress else None,
+                       batch_size=args.batch_size, dry_run=args.dry_run)
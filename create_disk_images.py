@@ -3,6 +3,7 @@
 
 import hashlib
 import collections
+import concurrent.futures
 import fcntl
 import glob
 import inspect
@@ -17,6 +18,8 @@ import pymongo
 
 import settings
 import kpov_util
+from disk_checksums import cached_digest, file_digest
+from disk_dedup import dedup_file
 from util import write_default_config
 
 def get_prepare_disks(db, course_id, task_id):
@@ -42,6 +45,10 @@ def create_snapshot(course_id, task_id, student_id, computer_name, disk_name, fm
 
         # ensure task dir exists
         os.makedirs(task_path, exist_ok=True)
+        # the old image may be linked to other students' images (see
+        # disk_dedup.py), so never write into it
+        if os.path.lexists(os.path.join(task_path, snap)):
+            os.unlink(os.path.join(task_path, snap))
 
         if fmt in ('vdi', 'vmdk'):
             # don’t use backing files, just copy the template
@@ -74,6 +81,25 @@ def create_snapshot(course_id, task_id, student_id, computer_name, disk_name, fm
 
     return task_dir, snap, backing
 
+# the download variant of each format as (file suffix, qemu-img options)
+EXPORT_FORMATS = {
+    # a single compressed image, no backing files needed
+    'qcow2': ('compressed.qcow2', ['-c', '-O', 'qcow2']),
+    # deflate-compressed, as used in OVA appliances
+    'vmdk': ('stream.vmdk', ['-O', 'vmdk', '-o', 'subformat=streamOptimized']),
+}
+
+def export_snapshot(task_path, snap, fmt):
+    # convert the personalized image to its download variant, flattening any
+    # backing chain; returns the exported file's name, size and digest
+    suffix, options = EXPORT_FORMATS[fmt]
+    export = '{}-{}'.format(os.path.splitext(snap)[0], suffix)
+    path = os.path.join(task_path, export)
+    subprocess.check_call(['qemu-img', 'convert', '-f', fmt] + options + [snap, export + '.tmp'], cwd=task_path)
+    os.replace(path + '.tmp', path)
+    # hash while the file is still in page cache
+    return {'file': export, 'size': os.path.getsize(path), 'sha256': file_digest(path)}
+
 def prepare_task_disks(course_id, task_id, student_id, fmt, computers):
     disks = collections.defaultdict(dict)
     templates = collections.defaultdict(dict)
@@ -162,6 +188,10 @@ if __name__ == '__main__':
         print("Create the pending disk images")
 
     db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    # images are hashed on these threads while the next format is built
+    hasher = concurrent.futures.ThreadPoolExecutor(getattr(settings, 'STUDENT_DISK_HASH_WORKERS', 4))
+    # and converted to their download variants on these
+    exporter = concurrent.futures.ThreadPoolExecutor(getattr(settings, 'STUDENT_DISK_EXPORT_WORKERS', 2))
 
     all_computers = collections.defaultdict(list)
     for computer in db.student_computers.find({"disk_urls": {"$exists": False}}):
@@ -179,6 +209,7 @@ if __name__ == '__main__':
             except IOError:
                 continue
 
+            task_path = os.path.join(settings.STUDENT_DISK_PATH, student_id, course_id, task_id)
             all_disks = collections.defaultdict(dict)
             for fmt in settings.STUDENT_DISK_FORMATS:
                 print("Creating {}/{} for {} [format={}]".format(course_id, task_id, student_id, fmt))
@@ -188,10 +219,44 @@ if __name__ == '__main__':
                             d = all_disks[computer].setdefault(disk, {'formats': []})
                             d['formats'] += [fmt]
                             d[fmt] = urls
+                            d.setdefault('sha256', {})[fmt] = \
+                                [hasher.submit(file_digest, os.path.join(task_path, urls[0]))] + \
+                                [hasher.submit(cached_digest, os.path.join(task_path, f)) for f in urls[1:]]
+                            if getattr(settings, 'STUDENT_DISK_EXPORT', False) and fmt in EXPORT_FORMATS:
+                                d.setdefault('exports', {})[fmt] = exporter.submit(export_snapshot, task_path, urls[0], fmt)
                 except Exception as ex:
                     print("E:", ex)
                     continue
 
+            lock_fp.write("hashing and exporting images\n")
+            for disks in all_disks.values():
+                for d in disks.values():
+                    exports = {}
+                    for fmt, future in d.pop('exports', {}).items():
+                        try:
+                            exports[fmt] = future.result()
+                        except Exception as ex:
+                            print("E: exporting:", ex)
+                            continue
+                        # compared to downloading the image with its backing files
+                        full_size = sum(os.path.getsize(os.path.join(task_path, f)) for f in d[fmt])
+                        exports[fmt]['ratio'] = round(exports[fmt]['size'] / full_size, 3)
+                    if exports:
+                        d['exports'] = exports
+                    try:
+                        d['sha256'] = {fmt: [f.result() for f in futures] for fmt, futures in d['sha256'].items()}
+                    except Exception as ex:
+                        print("E: hashing:", ex)
+                        del d['sha256']
+                        continue
+                    if getattr(settings, 'STUDENT_DISK_DEDUP', None):
+                        for fmt in d['formats']:
+                            dedup_file(db, os.path.join(task_path, d[fmt][0]), settings.STUDENT_DISK_DEDUP,
+                                       digest=d['sha256'][fmt][0])
+                        for export in exports.values():
+                            dedup_file(db, os.path.join(task_path, export['file']), settings.STUDENT_DISK_DEDUP,
+                                       digest=export['sha256'])
+
             lock_fp.write("saving URLs\n")
             for computer in computers:
                 comp_name = computer['name']
@@ -1,114 +1,333 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import keystoneclient.v2_0.client as ksclient
-import quantumclient.quantum.client as qclient
-import novaclient.client as nclient
-import settings
-import pymongo
-import sys
-import os
+import collections
+import concurrent.futures
 import fcntl
+import os
+import random
+import sys
+import threading
+import time
+
+import pymongo
+from pymongo import UpdateOne
+
+import settings
 
 ##########################################################
-      
-def create_network(qc, network_name, tenant_name):
-    net = {'name': network_name, 'admin_state_up': True, 'tenant_id': getattr(kc.tenants.find(name=tenant_name), 'id')}
-    network = qc.create_network({'network': net})
-    sub = {'name': network_name + "-subnet", 'cidr': '0.0.0.0/24', 'network_id': network['network']['id'], 'ip_version': 4, 'enable_dhcp': False, 'gateway_ip': None}
-    subnet = qc.create_subnet({'subnet': sub})
+
+def retry(fn, *args, attempts=5, backoff=1.0, **kwargs):
+    # retry an API call with exponential backoff and some jitter
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+def create_once(create, find, attempts=5, backoff=1.0):
+    # creating is not idempotent: a call that failed (e.g. timed out) may
+    # still have created the resource, so look it up by name before every
+    # attempt instead of just retrying
+    for attempt in range(attempts):
+        existing = retry(find)
+        if existing:
+            return existing
+        try:
+            return create()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+def first(items):
+    return items[0] if items else None
+
+_missing = object()
+
+def attr(obj, name, default=_missing):
+    # API results are objects, dictionaries in some client versions
+    if isinstance(obj, dict):
+        value = obj.get(name, default)
+    else:
+        value = getattr(obj, name, default)
+    if value is _missing:
+        raise AttributeError(name)
+    return value
+
+class Catalog:
+    # image, flavor, role and user lookups, done once per run
+    def __init__(self, kc):
+        self.kc = kc
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.cache = {}
+
+    def _get(self, kind, name, find):
+        # one lock per entry, so different lookups can run in parallel
+        with self.lock:
+            lock = self.locks.setdefault((kind, name), threading.Lock())
+        with lock:
+            if (kind, name) not in self.cache:
+                self.cache[(kind, name)] = retry(find, name=name)
+            return self.cache[(kind, name)]
+
+    def role(self, name):
+        return self._get('role', name, self.kc.roles.find)
+
+    def user(self, name):
+        return self._get('user', name, self.kc.users.find)
+
+    def image(self, nc, name):
+        return self._get('image', name, nc.images.find)
+
+    def flavor(self, nc, name):
+        return self._get('flavor', name, nc.flavors.find)
+
+def create_network(qc, network_name, tenant_id):
+    # returns the network, reusing the network and subnet if they exist
+    net = {'name': network_name, 'admin_state_up': True, 'tenant_id': tenant_id}
+    network = create_once(lambda: qc.create_network({'network': net})['network'],
+                          lambda: first(qc.list_networks(name=network_name, tenant_id=tenant_id)['networks']))
+    sub = {'name': network_name + "-subnet", 'cidr': '0.0.0.0/24', 'network_id': network['id'], 'ip_version': 4, 'enable_dhcp': False, 'gateway_ip': None}
+    subnet = create_once(lambda: qc.create_subnet({'subnet': sub})['subnet'],
+                         lambda: first(qc.list_subnets(name=sub['name'], network_id=network['id'])['subnets']))
     return network
-  
+
+def get_keystone_client():
+    import keystoneclient.v2_0.client as ksclient
+    return ksclient.Client(endpoint=settings.OS_ADMIN_AUTH_URL, token=settings.OS_ADMIN_TOKEN)
+
 def get_nova_client(tenant_name):
+    import novaclient.client as nclient
     return nclient.Client("1.1", username=settings.OS_ADMIN_USER, api_key=settings.OS_ADMIN_PASS, auth_url=settings.OS_AUTH_URL, project_id=tenant_name)
 
 def get_quantum_client(tenant_name):
+    import keystoneclient.v2_0.client as ksclient
+    import quantumclient.quantum.client as qclient
     kcsub = ksclient.Client(auth_url=settings.OS_AUTH_URL, username=settings.OS_ADMIN_USER, password=settings.OS_ADMIN_PASS, tenant_name=tenant_name)
     client = qclient.Client('2.0', endpoint_url=settings.OS_QUANTUM_URL, token=kcsub.auth_token)
     client.format = 'json'
     return client
-     
+
+def read_userdata(inst, log):
+    if not inst.get('config_drive'):
+        return None
+    if 'string' in inst['userdata'].keys():
+        return inst['userdata']['string']
+    elif 'file' in inst['userdata'].keys():
+        try:
+            with open(inst['userdata']['file']) as f:
+                return f.read()
+        except:
+            log("Problem reading file {0} for config drive. Using None instead.\n".format(inst['userdata']['file']))
+    return None
 
 ##########################################################
-def main():
-    kc = ksclient.Client(endpoint=settings.OS_ADMIN_AUTH_URL, token=settings.OS_ADMIN_TOKEN)
-    admin_role = kc.roles.find(name='admin')
-    member_role = kc.roles.find(name='Member')
 
-    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
-    l = db.student_tasks.find({'create_openstack': True})
-    projects = list()
-    for project in l:
-        task_id, student_id = project['task_id'], project['student_id']
-        if (task_id, student_id) not in projects:
-            projects.append((task_id, student_id))
-    #projects = [ ('01.predvaja','at9036@student.uni-lj.si'), ('01.predvaja', 'andrejtolic@fri1.uni-lj.si') ]
-    for task_id, student_id in projects:
-        l = db.student_tasks.find_one({'task_id': task_id, 'student_id': student_id, "create_openstack": True})
-        if l is None:
-            continue
-        lock_file = os.path.join(settings.OS_LOCKFILE_PATH, '{0}-{1}.lock'.format(student_id, task_id))
-        lock_fp = open(lock_file, 'w')
-        try:
-            fcntl.lockf(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError:
-            continue
+class Provisioner:
+    # Creates the OpenStack projects for (task, student) pairs. Projects are
+    # built concurrently, and so are the networks and servers within each
+    # project. Clients are passed in as factories so they can be replaced.
+    def __init__(self, db, kc, quantum_client=get_quantum_client, nova_client=get_nova_client,
+                 max_workers=8, lockfile_path=None, flush_size=500):
+        self.db = db
+        self.kc = kc
+        self.quantum_client = quantum_client
+        self.nova_client = nova_client
+        self.catalog = Catalog(kc)
+        self.max_workers = max_workers
+        self.lockfile_path = lockfile_path
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        self.writes = collections.defaultdict(list)
+        # API calls within a project share this pool, so the total number of
+        # parallel requests stays bounded
+        self.api_pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def write(self, collection, request):
+        with self.lock:
+            self.writes[collection].append(request)
+
+    def flush(self):
+        with self.lock:
+            writes, self.writes = self.writes, collections.defaultdict(list)
+        for collection, requests in writes.items():
+            self.db[collection].bulk_write(requests, ordered=True)
+
+    def checkpoint(self, key, state, changes):
+        # changes may use dotted keys like 'networks.<name>', as in $set
+        with self.lock:
+            for k, v in changes.items():
+                d = state
+                path = k.split('.')
+                for p in path[:-1]:
+                    d = d.setdefault(p, {})
+                d[path[-1]] = v
+        self.db.openstack_projects.update_one(key, {'$set': changes}, upsert=True)
+
+    def ensure_role(self, user, role, project):
+        # adding a role twice fails
+        def find():
+            roles = self.kc.roles.roles_for_user(user, project)
+            return any(attr(r, 'id') == attr(role, 'id') for r in roles)
+        create_once(lambda: self.kc.roles.add_user_role(user, role, project), find)
+
+    def provision(self, task_id, student_id, log=lambda s: None):
+        # Each step is checkpointed in openstack_projects. A rerun skips the
+        # finished steps. Resources are always looked up by name before they
+        # are created, so ones that were created but not yet recorded (e.g.
+        # after a crash) are adopted and nothing is created twice.
+        db = self.db
+        kc = self.kc
+        key = {'task_id': task_id, 'student_id': student_id}
+        state = db.openstack_projects.find_one(key)
+        if state is None:
+            state = {}
+        state.setdefault('networks', {})
+        state.setdefault('instances', {})
+        if state.get('done'):
+            self.write_records(key, state)
+            return state
+
         # Ustvarimo projekt
         project_name = "{0}-{1}".format(student_id, task_id)
-        project = kc.tenants.create(tenant_name=project_name)
-        lock_fp.write("Created project {0}.\n".format(project_name))
+        if 'project_id' not in state:
+            project = create_once(lambda: kc.tenants.create(tenant_name=project_name),
+                                  lambda: first(kc.tenants.findall(name=project_name)))
+            self.checkpoint(key, state, {'project_id': attr(project, 'id'), 'project_name': project_name})
+            log("Created project {0}.\n".format(project_name))
+        project = state['project_id']
+
         # Dodamo admin uporabnika v projekt
-        kc.roles.add_user_role(kc.users.find(name='admin'), admin_role, project)
-        lock_fp.write("Added user admin to project {0}.\n".format(project_name))
+        if not state.get('admin_role'):
+            self.ensure_role(self.catalog.user('admin'), self.catalog.role('admin'), project)
+            self.checkpoint(key, state, {'admin_role': True})
+            log("Added user admin to project {0}.\n".format(project_name))
+
         # Ustvarimo L2 omrezja
-        qc = get_quantum_client(tenant_name=project_name)
-        network_list = db.networks.find({'task_id': task_id})
-        nets = {}
-        for n in network_list:
-            net = create_network(qc, network_name=n['name'], tenant_name=project_name)
-            lock_fp.write("Created network {0}.".format(n['name']))
-            nets[n['name']] = {'net-id': net['network']['id']}
-            db.student_networks.update({'task_id': task_id, 'student_id': student_id, 'name': n['name']}, {'$set': {'network_id': net['network']['id'], 'public': n['public']}}, upsert=True)
-        #Ustvarimo instance
-        instance_list = db.computers_meta.find({'task_id': task_id})
-        nc = get_nova_client(tenant_name=project_name)
-        first_instance_in_project = True
-        for inst in instance_list:
-            image = nc.images.find(name=inst['image'])
-            flavor = nc.flavors.find(name=inst['flavor'])
-            instance_nets = [nets[iface['network']] for iface in inst['network_interfaces']]
-            if inst['config_drive']:
-                if 'string' in inst['userdata'].keys():
-                    udata = inst['userdata']['string']
-                elif 'file' in inst['userdata'].keys():
-                    try:
-                        udata = open(inst['userdata']['file'], 'r')
-                    except:
-                        udata = None
-                        lock_fp.write("Problem reading file {0} for config drive. Using None instead.".format(inst['userdata']['file']))
-            else:
-                udata = None
-            if first_instance_in_project:
-                scheduler_hints = None
-                first_instance_in_project = False
-            else:
-                s = db.student_computers.find_one({'task_id': task_id, 'student_id': student_id, 'name': inst['name']})
-                # Value corresponding to the 'same_host' key is a list (with just one element)
-                # of instances besides which to put the new instance.
-                scheduler_hints = {'same_host': [s['openstack_instance_id']] }
-            instance = nc.servers.create(name=project_name + "-" + inst['name'], image=image, flavor=flavor, nics=instance_nets, config_drive=inst['config_drive'], userdata=udata, scheduler_hints=scheduler_hints)
-            lock_fp.write("Created instance for computer {0}.".format(inst['name']))
+        network_list = {n['name']: n for n in db.networks.find({'task_id': task_id})}
+        missing = [name for name in network_list if name not in state['networks']]
+        if missing:
+            qc = self.quantum_client(tenant_name=project_name)
+            def ensure_network(name):
+                return create_network(qc, name, project)['id']
+            futures = {name: self.api_pool.submit(ensure_network, name) for name in missing}
+            for name, future in futures.items():
+                self.checkpoint(key, state, {'networks.' + name: future.result()})
+                log("Created network {0}.\n".format(name))
+        nets = {name: {'net-id': net_id} for name, net_id in state['networks'].items()}
+
+        # Ustvarimo instance
+        instance_list = list(db.computers_meta.find({'task_id': task_id}))
+        missing = [inst for inst in instance_list if inst['name'] not in state['instances']]
+        if missing:
+            nc = self.nova_client(tenant_name=project_name)
+            def ensure_instance(inst, scheduler_hints):
+                server_name = project_name + "-" + inst['name']
+                image = self.catalog.image(nc, inst['image'])
+                flavor = self.catalog.flavor(nc, inst['flavor'])
+                instance_nets = [nets[iface['network']] for iface in inst['network_interfaces']]
+                udata = read_userdata(inst, log)
+                instance = create_once(
+                    lambda: nc.servers.create(name=server_name, image=image, flavor=flavor, nics=instance_nets, config_drive=inst.get('config_drive', False), userdata=udata, scheduler_hints=scheduler_hints),
+                    lambda: first(nc.servers.findall(name=server_name)))
+                record = {'id': attr(instance, 'id'), 'host': attr(instance, 'OS-EXT-SRV-ATTR:host', None)}
+                self.checkpoint(key, state, {'instances.' + inst['name']: record})
+                log("Created instance for computer {0}.\n".format(inst['name']))
+
+            # the other instances are placed on the same host as the first
+            first_inst = instance_list[0]
+            if first_inst['name'] not in state['instances']:
+                self.api_pool.submit(ensure_instance, first_inst, None).result()
+                missing.remove(first_inst)
+            scheduler_hints = {'same_host': [state['instances'][first_inst['name']]['id']]}
+            futures = [self.api_pool.submit(ensure_instance, inst, scheduler_hints) for inst in missing]
+            for future in futures:
+                future.result()
+
+        # Dodamo studenta v projekt
+        if not state.get('member_role'):
+            self.ensure_role(self.catalog.user(student_id), self.catalog.role('Member'), project)
+            self.checkpoint(key, state, {'member_role': True})
+            log("Added user {0} to project {1}.\n".format(student_id, project_name))
+
+        self.checkpoint(key, state, {'done': True})
+        self.write_records(key, state)
+        return state
+
+    def write_records(self, key, state):
+        # the records the rest of the system reads, derived from the state
+        task_id, student_id = key['task_id'], key['student_id']
+        for n in self.db.networks.find({'task_id': task_id}):
+            if n['name'] in state['networks']:
+                self.write('student_networks', UpdateOne(dict(key, name=n['name']), {'$set': {'network_id': state['networks'][n['name']], 'public': n['public']}}, upsert=True))
+        for name, instance in state['instances'].items():
             # Write openstack instance id to mongo.
-            db.student_computers.update({'task_id': task_id, 'student_id': student_id, 'name': inst['name']}, {'$set': {'openstack_instance_id': instance['id'], 'openstack_host': instance['OS-EXT-SRV-ATTR:host'], 'openstack_finalized': False}, upsert=True)
-            # instance['status'] lahko BUILD, ACTIVE ali SHUTOFF
-            # instance = nova.servers.get(instance['id'])
-        db.student_tasks.update({'task_id': task_id, 'student_id': student_id}, {'$set': {'create_openstack': False, 'openstack_created': True}})
+            self.write('student_computers', UpdateOne(dict(key, name=name), {'$set': {'openstack_instance_id': instance['id'], 'openstack_host': instance['host'], 'openstack_finalized': False}}, upsert=True))
+        self.write('student_tasks', UpdateOne(key, {'$set': {'create_openstack': False, 'openstack_created': True}}))
+
+    def provision_locked(self, task_id, student_id):
+        if self.lockfile_path is None:
+            return self.provision(task_id, student_id)
+        lock_file = os.path.join(self.lockfile_path, '{0}-{1}.lock'.format(student_id, task_id))
+        with open(lock_file, 'w') as lock_fp:
+            try:
+                fcntl.lockf(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return None
+            def log(s):
+                with self.lock:
+                    lock_fp.write(s)
+            project = self.provision(task_id, student_id, log=log)
         os.unlink(lock_file)
-        lock_fp.close()
-    
+        return project
+
+    def provision_all(self, projects, out=sys.stdout):
+        failed = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+                futures = {executor.submit(self.provision_locked, task_id, student_id): (task_id, student_id)
+                           for task_id, student_id in projects}
+                for future in concurrent.futures.as_completed(futures):
+                    task_id, student_id = futures[future]
+                    try:
+                        future.result()
+                        print('{} {}: done'.format(task_id, student_id), file=out)
+                    except Exception as e:
+                        failed.append((task_id, student_id))
+                        print('{} {}: failed ({})'.format(task_id, student_id, e), file=out)
+                    if sum(len(w) for w in self.writes.values()) >= self.flush_size:
+                        self.flush()
+        finally:
+            self.flush()
+            self.api_pool.shutdown()
+        return failed
+
+def pending_projects(db):
+    projects = list()
+    for project in db.student_tasks.find({'create_openstack': True}):
+        task_id, student_id = project['task_id'], project['student_id']
+        if (task_id, student_id) not in projects:
+            projects.append((task_id, student_id))
+    return projects
+
+def unfinished_projects(db):
+    # projects whose provisioning was interrupted
+    return [(p['task_id'], p['student_id'])
+            for p in db.openstack_projects.find({'done': {'$ne': True}}, {'task_id': 1, 'student_id': 1})]
+
+def main():
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    provisioner = Provisioner(db, get_keystone_client(),
+        max_workers=getattr(settings, 'OS_MAX_WORKERS', 8),
+        lockfile_path=settings.OS_LOCKFILE_PATH)
+    failed = provisioner.provision_all(pending_projects(db))
     # TODO v loceni skripti.
     # povezi test-net na brarbiters, po izklopu instanc guestfs nad diski in create_image.
-    # Dodamo studenta v projekt
-    kc.roles.add_user_role(kc.users.find(name=student_id), member_role, project)
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,60 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# sha256 digests of disk images. Template images are shared by all students
+# and never change, so their digests are kept in <image>.sha256 next to the
+# image and each template is read only once.
+
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 1 << 20
+
+_cache = {}
+_lock = threading.Lock()
+
+def file_digest(path):
+    # hashlib releases the GIL for large buffers, so several files can be
+    # hashed in parallel on threads
+    h = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def cached_digest(path):
+    # digest of an image that is not modified, such as a backing file
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    stamp = '{} {}'.format(st.st_size, st.st_mtime_ns)
+    key = (real, stamp)
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+
+    digest = None
+    try:
+        with open(real + '.sha256') as f:
+            cached_stamp, cached = f.read().strip().rsplit(' ', 1)
+        if cached_stamp == stamp:
+            digest = cached
+    except (OSError, ValueError):
+        pass
+    if digest is None:
+        digest = file_digest(real)
+        try:
+            tmp = '{}.sha256.{}.tmp'.format(real, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write('{} {}\n'.format(stamp, digest))
+            os.replace(tmp, real + '.sha256')
+        except OSError:
+            # the template directory may be read-only
+            pass
+    with _lock:
+        _cache[key] = digest
+    return digest
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Store identical student disk images once. Each finished image is hashed; the
+# first image with a given hash is linked into STUDENT_DISK_PATH/.dedup, and
+# later ones are replaced by hardlinks (or reflinks) to that copy. The
+# disk_blobs collection records which student files use each stored copy:
+#   {_id: sha256, path, size, refs: [{path, size, mtime}]}
+# A reference is valid while the student file exists and has the recorded
+# size and mtime, so copies that are no longer used can be removed with --gc.
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+
+import pymongo
+
+import settings
+from disk_checksums import file_digest
+
+def store_dir():
+    return getattr(settings, 'STUDENT_DISK_DEDUP_PATH', os.path.join(settings.STUDENT_DISK_PATH, '.dedup'))
+
+def _copy(src, dst, mode):
+    if mode == 'reflink':
+        subprocess.check_call(['cp', '--reflink=always', src, dst])
+    else:
+        os.link(src, dst)
+
+def _ref(path):
+    st = os.stat(path)
+    return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+def _valid(ref):
+    try:
+        st = os.stat(ref['path'])
+    except OSError:
+        return False
+    return st.st_size == ref['size'] and st.st_mtime_ns == ref['mtime']
+
+def dedup_file(db, path, mode='hardlink', digest=None):
+    # replace path with a link to the stored copy of identical content, or
+    # store it if it is the first; returns the digest and whether path was
+    # replaced
+    path = os.path.abspath(path)
+    if digest is None:
+        digest = file_digest(path)
+    blob = os.path.join(store_dir(), digest[:2], digest + os.path.splitext(path)[1])
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    replaced = False
+    try:
+        if not os.path.exists(blob):
+            # link the new copy in under a temporary name, so a concurrent
+            # build never sees a partial file
+            tmp = '{}.{}.tmp'.format(blob, os.getpid())
+            _copy(path, tmp, mode)
+            try:
+                os.link(tmp, blob)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp)
+        if not os.path.samefile(blob, path):
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            _copy(blob, tmp, mode)
+            os.replace(tmp, path)
+            replaced = True
+    except OSError as e:
+        # e.g. the store is on another file system
+        print('not deduplicating {}: {}'.format(path, e), file=sys.stderr)
+        return digest, False
+    db.disk_blobs.update_many({'_id': {'$ne': digest}, 'refs.path': path}, {'$pull': {'refs': {'path': path}}})
+    db.disk_blobs.update_one({'_id': digest}, {'$pull': {'refs': {'path': path}}})
+    db.disk_blobs.update_one({'_id': digest}, {
+        '$setOnInsert': {'path': blob, 'size': os.path.getsize(blob), 'created': datetime.datetime.now()},
+        '$push': {'refs': _ref(path)}}, upsert=True)
+    return digest, replaced
+
+def scan(db, root, mode='hardlink', extensions=('.qcow2', '.vmdk', '.vdi'), out=sys.stdout):
+    # deduplicate images built before deduplication was enabled
+    skip = os.path.abspath(store_dir())
+    for dirpath, dirnames, filenames in os.walk(root):
+        if os.path.abspath(dirpath).startswith(skip):
+            dirnames[:] = []
+            continue
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            if os.path.splitext(fname)[1] in extensions and not os.path.islink(path):
+                digest, replaced = dedup_file(db, path, mode)
+                print('{} {}{}'.format(digest[:12], path, ' (linked)' if replaced else ''), file=out)
+
+def gc(db, dry_run=False, out=sys.stdout):
+    # drop references to changed or removed files, then stored copies that
+    # are not referenced any more
+    removed = 0
+    for record in db.disk_blobs.find():
+        refs = [ref for ref in record.get('refs', []) if _valid(ref)]
+        if refs:
+            if len(refs) != len(record['refs']) and not dry_run:
+                db.disk_blobs.update_one({'_id': record['_id']}, {'$set': {'refs': refs}})
+            continue
+        print('removing {}'.format(record['path']), file=out)
+        removed += record.get('size', 0)
+        if not dry_run:
+            try:
+                os.unlink(record['path'])
+            except FileNotFoundError:
+                pass
+            db.disk_blobs.delete_one({'_id': record['_id']})
+    return removed
+
+def report(db, out=sys.stdout):
+    blobs = files = stored = logical = 0
+    for record in db.disk_blobs.find():
+        refs = [ref for ref in record.get('refs', []) if _valid(ref)]
+        blobs += 1
+        files += len(refs)
+        stored += record.get('size', 0)
+        logical += record.get('size', 0) * len(refs)
+    print('{} images stored as {} copies: {:.1f} GiB instead of {:.1f} GiB, saved {:.1f} GiB'.format(
+        files, blobs, stored / 2**30, logical / 2**30, (logical - stored) / 2**30), file=out)
+    return {'files': files, 'blobs': blobs, 'stored': stored, 'logical': logical}
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Deduplicate student disk images.')
+    argparser.add_argument('--scan', action='store_true',
+        help='deduplicate existing images under STUDENT_DISK_PATH')
+    argparser.add_argument('--gc', action='store_true', help='remove stored copies no longer in use')
+    argparser.add_argument('-n', '--dry-run', action='store_true')
+    args = argparser.parse_args()
+
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    mode = getattr(settings, 'STUDENT_DISK_DEDUP', None) or 'hardlink'
+    if args.scan:
+        scan(db, settings.STUDENT_DISK_PATH, mode)
+    if args.gc:
+        freed = gc(db, dry_run=args.dry_run)
+        print('{} {:.1f} GiB'.format('would free' if args.dry_run else 'freed', freed / 2**30))
+    report(db)
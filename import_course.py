@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Import all tasks of a course in one go. Task files are loaded in parallel,
+# then each collection is updated with one bulk write. If writing fails, the
+# affected documents are restored to what they were before the import.
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import os
+import re
+import sys
+import time
+
+import pymongo
+
+import settings
+from add_task import load_task, task_requests
+
+def find_tasks(course_dir):
+    # one task per lesson, linked from <course_dir>/<lesson>/preparation
+    for i in sorted(glob.glob(os.path.join(course_dir, '*'))):
+        n = os.path.basename(i)
+        task_dir = os.path.join(i, 'preparation')
+        if not os.path.exists(task_dir):
+            continue
+        o = re.sub(r'.*tasks/', '', os.readlink(task_dir)) if os.path.islink(task_dir) else ''
+        yield task_dir, '{}-preparation-{}'.format(n, o)
+
+def timed_load_task(dirname):
+    start = time.perf_counter()
+    task = load_task(dirname)
+    return task, time.perf_counter() - start
+
+def import_course(db, course_id, tasks, jobs=None, force=False, out=sys.stdout):
+    # load all tasks, skipping the ones that fail
+    loaded = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(timed_load_task, dirname): (dirname, task_id)
+                   for dirname, task_id in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            dirname, task_id = futures[future]
+            try:
+                task, elapsed = future.result()
+            except Exception as e:
+                print('{}: skipped ({})'.format(task_id, e), file=out)
+                continue
+            loaded[task_id] = task
+            print('{}: loaded in {:.2f} s'.format(task_id, elapsed), file=out)
+    if not loaded:
+        return loaded
+
+    stored_hashes = {}
+    if not force:
+        for record in db.task_hashes.find({'course_id': course_id, 'task_id': {'$in': list(loaded)}}):
+            stored_hashes[record['task_id']] = record['hashes']
+
+    requests = collections.defaultdict(list)
+    for task_id in sorted(loaded):
+        task_reqs, changed = task_requests(course_id, task_id, loaded[task_id], stored_hashes.get(task_id))
+        print('{}: changed {}'.format(task_id, ', '.join(sorted(changed)) if changed else 'nothing'), file=out)
+        for collection, reqs in task_reqs.items():
+            requests[collection] += reqs
+    if not requests:
+        return loaded
+
+    # remember the current state of everything we are about to change
+    key = {'course_id': course_id, 'task_id': {'$in': list(loaded)}}
+    backup = {collection: list(db[collection].find(key)) for collection in requests}
+
+    touched = []
+    try:
+        for collection, reqs in requests.items():
+            touched.append(collection)
+            start = time.perf_counter()
+            db[collection].bulk_write(reqs, ordered=True)
+            print('{}: {} writes in {:.2f} s'.format(collection, len(reqs), time.perf_counter() - start), file=out)
+    except Exception as e:
+        print('import failed ({}), rolling back'.format(e), file=out)
+        for collection in touched:
+            db[collection].delete_many(key)
+            if backup[collection]:
+                db[collection].insert_many(backup[collection])
+        raise
+    return loaded
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Import all tasks of a course.')
+    argparser.add_argument('course_name')
+    argparser.add_argument('course_dir')
+    argparser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of processes loading task files (default: number of CPUs)')
+    argparser.add_argument('-f', '--force', action='store_true',
+        help='rewrite all components even if unchanged')
+    args = argparser.parse_args()
+
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    start = time.perf_counter()
+    try:
+        loaded = import_course(db, args.course_name, find_tasks(args.course_dir),
+                               jobs=args.jobs, force=args.force)
+    except Exception:
+        sys.exit(1)
+    print('imported {} tasks in {:.2f} s'.format(len(loaded), time.perf_counter() - start))
@@ -5,13 +5,4 @@ if [ $# -lt 2 ]; then
   exit 1
 fi
 
-course_name=$1
-course_dir=$2
-
-
-
-for i in ${course_dir}/*; do 
-    n=$(basename $i)
-    o=$(readlink ${i}/preparation | sed -e 's/.*tasks\///')
-    ./add_task.py "${i}/preparation" "${course_name}/$n-preparation-$o"; 
-done
+exec "$(dirname "$0")/import_course.py" "$@"
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import concurrent.futures
 import glob
 import os
 import sys
 
-def print_instructions(p, fname):
+import task_manifest
+
+def read_instructions(path):
+    try:
+        return task_manifest.load(path, globals=globals())['values']['instructions'], None
+    except Exception as e:
+        return None, e
+
+def print_instructions(p, fname, instructions, error=None):
     try:
         print("---------------")
         l = p.split(os.sep)
@@ -19,22 +28,27 @@ def print_instructions(p, fname):
             l1.append(s)
         print(p)
         print(" - ".join(l1))
-        with open(os.path.join(p, fname)) as f:
-            task_code = compile(f.read(), fname, 'exec')
-            d = {}
-            exec(task_code, globals(), d)
-            for lang, text in d['instructions'].items():
-                print("Language: {0}".format(lang))
-                print(text.encode('utf-8'))
-                print("")
+        if error is not None:
+            raise error
+        for lang, text in instructions.items():
+            print("Language: {0}".format(lang))
+            print(text.encode('utf-8'))
+            print("")
     except Exception as e:
         print(e)
 
 if __name__ == '__main__':
     l = glob.glob(sys.argv[1])
     l.sort()
+    tasks = []
     for d in l:
         for root, dirs, files in os.walk(d, followlinks=True):
             for fname in files:
                 if fname == 'task.py':
-                    print_instructions(root, fname) 
+                    tasks.append((root, fname))
+    # parse the tasks in parallel, print them in order
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(read_instructions,
+            [os.path.join(root, fname) for root, fname in tasks], chunksize=16)
+        for (root, fname), (instructions, error) in zip(tasks, results):
+            print_instructions(root, fname, instructions, error)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import atexit
 import collections
 import glob
 import itertools
@@ -8,38 +9,134 @@ import math
 import os
 import random
 import re
+import shutil
 import socket
 import string
 import struct
 import subprocess
+import tempfile
+
+# authenticated ssh sessions kept open while task() runs, keyed by (host, user);
+# each entry is (pxssh session, password). The sessions are masters of OpenSSH
+# control sockets in _ssh_control_dir, so each ssh_test opens its shell on a
+# new channel without logging in again.
+_ssh_sessions = {}
+_ssh_control_dir = None
+
+# set in each shell, so the end of a command's output can be found
+_SSH_PROMPT = r'\[KPOV\][\$#] '
+
+def _ssh_control_path():
+    global _ssh_control_dir
+    if _ssh_control_dir is None:
+        _ssh_control_dir = tempfile.mkdtemp(prefix='kpov-ssh-')
+    return os.path.join(_ssh_control_dir, '%C')
+
+def _ssh_login(host, user, password):
+    from pexpect import pxssh
+
+    s = pxssh.pxssh(encoding='utf-8', timeout=10, options={
+        'ControlMaster': 'yes',
+        'ControlPath': _ssh_control_path(),
+    })
+    s.login(host, user, password,
+        original_prompt='~[#$] ',
+        auto_prompt_reset=False)
+    return s, password
+
+def _ssh_alive(host, user):
+    # ask the master connection whether it is still up
+    return subprocess.run(['ssh', '-q', '-O', 'check',
+            '-S', _ssh_control_path(),
+            '-l', user, host],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def _ssh_shell(host, user):
+    import pexpect
+
+    # an interactive shell through the master's socket; with BatchMode ssh
+    # fails instead of asking for a password if the master is gone
+    s = pexpect.spawn('ssh', ['-tt', '-S', _ssh_control_path(),
+            '-o', 'ControlMaster=no', '-o', 'BatchMode=yes',
+            '-l', user, host],
+        encoding='utf-8', timeout=10)
+    try:
+        s.expect('~[#$] ')
+        # the motd printed for this session, not the one of the first login
+        motd = s.before
+        s.sendline("unset PROMPT_COMMAND; PS1='[KPOV]\\$ '")
+        s.expect(_SSH_PROMPT)
+    except Exception:
+        s.close()
+        raise
+    return s, motd
+
+def _ssh_open(host, user, password):
+    import pexpect
+
+    session = _ssh_sessions.get((host, user))
+    # a different password must go through a real login
+    if session is not None and session[1] == password:
+        try:
+            return _ssh_shell(host, user)
+        except pexpect.exceptions.ExceptionPexpect:
+            # only log in again if the master connection is gone
+            if _ssh_alive(host, user):
+                raise
+    _ssh_drop(host, user)
+    _ssh_sessions[(host, user)] = _ssh_login(host, user, password)
+    return _ssh_shell(host, user)
+
+def _ssh_drop(host, user):
+    session = _ssh_sessions.pop((host, user), None)
+    if session is not None:
+        session[0].close()
+
+def ssh_close_all():
+    global _ssh_control_dir
+    for s, password in _ssh_sessions.values():
+        try:
+            s.logout()
+        except Exception:
+            s.close()
+    _ssh_sessions.clear()
+    if _ssh_control_dir is not None:
+        shutil.rmtree(_ssh_control_dir, ignore_errors=True)
+        _ssh_control_dir = None
 
 def ssh_test(host, user, password, commands=()):
     import pexpect
-    from pexpect import pxssh
 
     results = collections.defaultdict(str)
     try:
-        s = pxssh.pxssh(encoding='utf-8', timeout=10)
-        s.login(host, user, password,
-            original_prompt='~[#$] ',
-            auto_prompt_reset=False)
+        s, motd = _ssh_open(host, user, password)
         results['ssh'] = True
-        results['motd'] = s.before
-        s.set_unique_prompt()
-        for test, command in commands:
-            s.sendline(command)
-            s.prompt()
-            if test:
-                results[test] = s.before[len(command+'\r\n'):].strip().replace('\r\n', '\n')
-        s.logout()
+        results['motd'] = motd
+        try:
+            # all commands run in one shell, so they share the working
+            # directory, environment and tty
+            for test, command in commands:
+                s.sendline(command)
+                s.expect(_SSH_PROMPT)
+                if test:
+                    results[test] = s.before[len(command+'\r\n'):].strip().replace('\r\n', '\n')
+            s.sendline('exit')
+            s.expect(pexpect.EOF)
+        finally:
+            s.close()
     except pexpect.exceptions.EOF as e:
+        _ssh_drop(host, user)
         results['ssh'] = 'connection to {} as {}/{} failed (EOF)'.format(host, user, password)
     except pexpect.exceptions.TIMEOUT as e:
+        _ssh_drop(host, user)
         results['ssh'] = 'connection to {} as {}/{} failed (timeout)'.format(host, user, password)
     except Exception as e:
+        _ssh_drop(host, user)
         results['ssh'] = 'connection to {} as {}/{} failed ({})'.format(host, user, password, e)
     return results
 
+atexit.register(ssh_close_all)
+
 # omit i, l, o, I, O, 1, 0 for readability
 uppers = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
 lowers = 'abcdefghjkmnpqrstuvwxyz'
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Re-run the current task_check over stored results, e.g. after fixing a checker.
+
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import random
+import signal
+import sys
+import time
+
+import pymongo
+from bson import ObjectId
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+# checkers are compiled with this module's globals, like in the web app
+import kpov_util
+import settings
+from result_storage import pack, unpack
+
+_task_check = None
+
+class CheckerTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise CheckerTimeout('timed out')
+
+def init_worker(task_check_source):
+    global _task_check
+    d = {}
+    exec(compile(task_check_source, 'checker.py', 'exec'), globals(), d)
+    _task_check = d['task_check']
+    signal.signal(signal.SIGALRM, _alarm)
+
+def check(job):
+    # same as results_json in the web app, with a time limit for each check
+    result_id, results, params, timeout = job
+    signal.alarm(timeout)
+    try:
+        res, hints = _task_check(collections.defaultdict(str, results), params)
+    except Exception as e:
+        hints = ["Checker died: " + str(e)]
+        res = 0
+    finally:
+        signal.alarm(0)
+    if (isinstance(res, int) or isinstance(res, float)) and res > 0:
+        res_status = 'OK'
+    else:
+        res_status = 'NOT OK'
+    return result_id, res, hints, res_status
+
+def get_student_params(db, course_id, task_id, student_ids, cache):
+    missing = [s for s in student_ids if s not in cache]
+    if missing:
+        for record in db.task_params.find(
+                {'course_id': course_id, 'task_id': task_id, 'student_id': {'$in': missing}},
+                {'student_id': 1, 'params': 1, 'token': 1}):
+            cache[record['student_id']] = record
+    return cache
+
+def batches(cursor, size):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def regrade(db, course_id, task_id, student_id=None, in_place=False, dry_run=False,
+            processes=None, timeout=30, batch_size=500, out=sys.stdout):
+    task_check_source = db.task_checkers.find_one({'course_id': course_id, 'task_id': task_id})['source']
+
+    meta = db.task_params_meta.find_one({'course_id': course_id, 'task_id': task_id})
+    writable = {name for name, m in (meta or {}).get('params', {}).items() if m.get('w', False)}
+
+    query = {'course_id': course_id, 'task_id': task_id, 'superseded_by': {'$exists': False}}
+    if student_id is not None:
+        query['student_id'] = student_id
+    # new versions are inserted while the cursor is open and must not be
+    # regraded again
+    last = db.results.find_one(query, {'_id': 1}, sort=[('_id', -1)])
+    if last is None:
+        return collections.Counter()
+    query['_id'] = {'$lte': last['_id']}
+    cursor = db.results.find(query, no_cursor_timeout=True, batch_size=batch_size)
+
+    compression = getattr(settings, 'RESULTS_COMPRESSION', None)
+    stats = collections.Counter()
+    student_params = {}
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(task_check_source,))
+    try:
+        for batch in batches(cursor, batch_size):
+            get_student_params(db, course_id, task_id, {doc['student_id'] for doc in batch}, student_params)
+            docs = {}
+            jobs = []
+            for doc in map(unpack, batch):
+                record = student_params.get(doc['student_id'])
+                if not record or record.get('params') is None:
+                    stats['no params'] += 1
+                    continue
+                if writable and 'user_params' not in doc:
+                    # stored before the writable params were kept; checking
+                    # with the generated values could give a wrong score
+                    stats['no user params'] += 1
+                    continue
+                params = dict(record['params'])
+                params.update((k, v) for k, v in doc.get('user_params', {}).items() if k in writable)
+                params['token'] = record.get('token', '')
+                docs[doc['_id']] = doc
+                jobs.append((doc['_id'], doc.get('response', {}), params, timeout))
+
+            requests = []
+            now = datetime.datetime.now()
+            for result_id, res, hints, res_status in pool.imap_unordered(check, jobs):
+                doc = docs[result_id]
+                stats['checked'] += 1
+                if res == doc.get('result') and hints == doc.get('hints'):
+                    stats['unchanged'] += 1
+                    continue
+                stats['changed'] += 1
+                if doc.get('result') != res:
+                    stats['score changed'] += 1
+                    print('{} {} {}: {} -> {}'.format(
+                        doc['student_id'], doc.get('time'), result_id, doc.get('result'), res), file=out)
+                update = {'result': res, 'hints': hints, 'status': res_status}
+                if in_place:
+                    new_doc = dict(doc, regraded=now)
+                    new_doc.update(update)
+                    requests.append(ReplaceOne({'_id': result_id}, pack(new_doc, compression)))
+                else:
+                    new_doc = dict(doc, _id=ObjectId())
+                    new_doc.update(update)
+                    new_doc['version'] = doc.get('version', 0) + 1
+                    new_doc['regraded_from'] = result_id
+                    new_doc['regraded'] = now
+                    requests.append(InsertOne(pack(new_doc, compression)))
+                    requests.append(UpdateOne({'_id': result_id},
+                        {'$set': {'superseded_by': new_doc['_id']}}))
+
+            if requests and not dry_run:
+                db.results.bulk_write(requests, ordered=False)
+
+            elapsed = time.perf_counter() - start
+            print('checked {} results, {:.1f}/s'.format(stats['checked'], stats['checked'] / elapsed), file=sys.stderr)
+    finally:
+        pool.terminate()
+        cursor.close()
+
+    if stats['no user params']:
+        print('skipped {} results without the writable params the student sent'.format(
+            stats['no user params']), file=out)
+    stats['seconds'] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Regrade stored results with the current checker.')
+    argparser.add_argument('task', help='course_id/task_id')
+    argparser.add_argument('-s', '--student', help='only regrade this student')
+    argparser.add_argument('-i', '--in-place', action='store_true',
+        help='overwrite scores instead of storing new result versions')
+    argparser.add_argument('-n', '--dry-run', action='store_true',
+        help='only print the score changes')
+    argparser.add_argument('-j', '--processes', type=int, default=None,
+        help='number of checker processes (default: number of CPUs)')
+    argparser.add_argument('-t', '--timeout', type=int, default=30,
+        help='seconds allowed for each check')
+    argparser.add_argument('-b', '--batch-size', type=int, default=500)
+    args = argparser.parse_args()
+
+    try:
+        course_id, task_id = args.task.split('/')
+    except ValueError:
+        print('task should be given as course_id/task_id')
+        exit(1)
+
+    db = pymongo.MongoClient(settings.DB_URI).get_default_database()
+    stats = regrade(db, course_id, task_id, student_id=args.student,
+                    in_place=args.in_place, dry_run=args.dry_run,
+                    processes=args.processes, timeout=args.timeout,
+                    batch_size=args.batch_size)
+    print(json.dumps(dict(stats)))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Replay params.json and results.json traffic recorded by the web app (see
+# TRAFFIC_RECORD_PATH in settings) against a local instance, and check that
+# it returns the same params and grades. The database of the local instance
+# is given the recorded params and tokens of each (anonymized) student, and
+# with --recorded-checkers also the recorded checkers and params_meta.
+#
+# Checkers that use params['token'] see the anonymized token and may grade
+# differently than when the traffic was recorded.
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+
+from pymongo import UpdateOne
+
+from benchmark_judge import AppClient, HttpClient, get_db, load_app, percentile
+
+def read_trace(path):
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def seed(db, records, recorded_checkers=False):
+    # tokens and params of every student, and optionally the last recorded
+    # version of each checker
+    task_params = {}
+    public_params = {}
+    tasks = {}
+    for r in sorted(records, key=lambda r: r['t']):
+        if r['kind'] == 'task':
+            tasks[(r['course_id'], r['task_id'])] = r
+            continue
+        key = (r['course_id'], r['task_id'], r['student_id'])
+        task_params.setdefault(key, {'token': r['token']})
+        if r['kind'] == 'results':
+            # the first params seen are the ones the student got
+            task_params[key].setdefault('params', r['params'])
+        elif r.get('response'):
+            # params.json only returns the public params; they are enough
+            # to answer it the same way for students without results
+            public_params.setdefault(key, r['response'])
+    for key, params in public_params.items():
+        task_params[key].setdefault('params', params)
+    if task_params:
+        db.task_params.bulk_write([
+            UpdateOne({'course_id': c, 'task_id': t, 'student_id': s}, {'$set': fields}, upsert=True)
+            for (c, t, s), fields in task_params.items()], ordered=False)
+    if recorded_checkers:
+        for (c, t), r in tasks.items():
+            key = {'course_id': c, 'task_id': t}
+            db.task_checkers.update_one(key, {'$set': {'source': r['checker_source']}}, upsert=True)
+            db.task_params_meta.update_one(key, {'$set': {'params': r['params_meta']}}, upsert=True)
+    return len(task_params), len(tasks)
+
+def request_for(r):
+    base = '/tasks/{}/{}/'.format(r['course_id'], r['task_id'])
+    if r['kind'] == 'params':
+        return 'POST', base + 'params.json', r['student_id'], {'token': r['token']}
+    return 'POST', base + 'results.json', r['student_id'], {
+        'token': r['token'], 'results': json.dumps(r['results']), 'params': json.dumps(r['user_params'])}
+
+def replay(client, records, speed=1.0, concurrency=8, out=sys.stdout, max_diffs=20):
+    # speed is relative to the recorded pace; 0 sends requests as fast as possible
+    requests = sorted((r for r in records if r['kind'] in ('params', 'results')), key=lambda r: r['t'])
+    if not requests:
+        return {}
+    latencies = collections.defaultdict(list)
+    stats = collections.Counter()
+    lock = threading.Lock()
+
+    def send(r):
+        start = time.perf_counter()
+        try:
+            status, body = client.fetch(*request_for(r))
+            response = json.loads(body) if status == 200 else None
+        except Exception as e:
+            status, response = repr(e), None
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies[r['kind']].append(elapsed)
+            if response is None:
+                stats[r['kind'] + ' errors'] += 1
+            elif response == r['response']:
+                stats[r['kind'] + ' same'] += 1
+            else:
+                stats[r['kind'] + ' different'] += 1
+                if stats['printed'] < max_diffs:
+                    stats['printed'] += 1
+                    print('{} {}/{} {}: recorded {}, replayed {}'.format(
+                        r['kind'], r['course_id'], r['task_id'], r['student_id'],
+                        json.dumps(r['response']), json.dumps(response)), file=out)
+
+    t0 = requests[0]['t']
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for r in requests:
+            if speed > 0:
+                delay = (r['t'] - t0) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, r)
+    elapsed = time.perf_counter() - start
+    stats.pop('printed', None)
+
+    report = {'requests': len(requests), 'seconds': elapsed, 'throughput': len(requests) / elapsed,
+              'outcomes': dict(stats), 'endpoints': {}}
+    for kind, values in latencies.items():
+        values.sort()
+        report['endpoints'][kind] = {'requests': len(values),
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99)}
+    return report
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Replay recorded grading traffic against a local judge.')
+    argparser.add_argument('trace', help='file written by the web app with TRAFFIC_RECORD_PATH')
+    argparser.add_argument('--db-uri', default='mongodb://localhost:27017/kpov_replay',
+        help='database of the local instance; task_params of the recorded students are overwritten')
+    argparser.add_argument('--url', help='replay against a running server instead of importing the app')
+    argparser.add_argument('--app-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web', 'kpov_judge'))
+    argparser.add_argument('--in-memory', action='store_true', help='use mongomock instead of a mongod')
+    argparser.add_argument('--recorded-checkers', action='store_true',
+        help='install the recorded checkers and params_meta instead of keeping the local ones')
+    argparser.add_argument('--no-seed', action='store_true')
+    argparser.add_argument('-s', '--speed', type=float, default=1.0,
+        help='replay speed relative to the recording, e.g. 10; 0 for as fast as possible')
+    argparser.add_argument('-c', '--concurrency', type=int, default=8)
+    argparser.add_argument('-o', '--output', help='write the report as JSON')
+    args = argparser.parse_args()
+    if args.url and args.in_memory:
+        argparser.error('--url cannot be used with --in-memory')
+
+    records = list(read_trace(args.trace))
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        client = AppClient(load_app(args.app_dir, args.db_uri, args.in_memory))
+    if not args.no_seed:
+        students, tasks = seed(get_db(args.db_uri), records, args.recorded_checkers)
+        print('seeded {} students, {} checkers'.format(students, tasks if args.recorded_checkers else 0), file=sys.stderr)
+    report = replay(client, records, speed=args.speed, concurrency=args.concurrency)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report['outcomes'], sort_keys=True))
+    for kind, e in report['endpoints'].items():
+        print('{:<8} {:>6} requests  p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms'.format(
+            kind, e['requests'], e['p50'] * 1000, e['p95'] * 1000, e['p99'] * 1000))
@@ -0,0 +1,57 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Compact storage of submitted results. The response and hints of a result
+# can be stored as one compressed BSON document in the field 'packed'; unpack
+# restores them, so code reading results should pass them through unpack.
+
+import zlib
+
+import bson
+
+# fields moved into the packed document
+PACKED_FIELDS = ('response', 'hints')
+
+def _zstd():
+    # zstandard is optional, only needed for RESULTS_COMPRESSION='zstd'
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("results compressed with 'zstd' need the zstandard package (pip install zstandard)")
+    return zstandard
+
+def compress(data, method):
+    if method == 'zlib':
+        return zlib.compress(data, 6)
+    if method == 'zstd':
+        return _zstd().ZstdCompressor(level=10).compress(data)
+    raise ValueError('unknown compression: {}'.format(method))
+
+def decompress(data, method):
+    if method == 'zlib':
+        return zlib.decompress(data)
+    if method == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(data)
+    raise ValueError('unknown compression: {}'.format(method))
+
+def pack(record, method='zlib'):
+    # return a copy of record with response and hints compressed; with no
+    # method the record is returned unchanged
+    if not method or 'packed' in record:
+        return record
+    record = dict(record)
+    fields = {k: record.pop(k) for k in PACKED_FIELDS if k in record}
+    record['packed'] = bson.Binary(compress(bson.encode(fields), method))
+    record['packing'] = method
+    return record
+
+def unpack(record):
+    # return record with response and hints as they were submitted
+    if record is None or 'packed' not in record:
+        return record
+    record = dict(record)
+    data = decompress(record.pop('packed'), record.pop('packing', 'zlib'))
+    record.update(bson.decode(data))
+    return record
+
+# fields to add to a projection that includes any of PACKED_FIELDS
+PACKED_PROJECTION = {'packed': 1, 'packing': 1}
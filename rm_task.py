@@ -19,9 +19,11 @@ if __name__ == '__main__':
     db.prepare_disks.remove({'task_id': task_id})
     db.student_computers.remove({'task_id': task_id})
     db.results.remove({'task_id': task_id})
+    db.results_archive.remove({'task_id': task_id})
     db.gen_params.remove({'task_id': task_id})
     db.task_params_meta.remove({'task_id': task_id})
     db.task_params.remove({'task_id': task_id})
     db.task_instructions.remove({'task_id': task_id})
     db.howtos.remove({'task_id': task_id})
     db.howto_images.remove({'task_id': task_id})
+    db.task_hashes.remove({'task_id': task_id})
@@ -7,9 +7,54 @@ DISK_TEMPLATE_PATH = '/home/kpov_judge/kpov-virtualke/templates'
 STUDENT_DISK_PATH='/home/kpov_judge/kpov-virtualke/students'
 STUDENT_DISK_FORMATS=['qcow2', 'vmdk']
 STUDENT_DISK_COW=True
+# store identical student images once as 'hardlink' or 'reflink' copies in
+# STUDENT_DISK_PATH/.dedup (None to disable), see disk_dedup.py
+STUDENT_DISK_DEDUP=None
+# threads hashing finished images for the published SHA256SUMS
+STUDENT_DISK_HASH_WORKERS=4
+# also build compressed download variants (flattened qcow2, streamOptimized
+# vmdk) and offer them when smaller than the image with its backing files
+STUDENT_DISK_EXPORT=True
+STUDENT_DISK_EXPORT_WORKERS=2
 STUDENT_DISK_URL='https://judge_server.example.com/kpov-disks3/'
 STUDENT_LOCKFILE_PATH='/home/kpov_judge/kpov-virtualke/lockfiles'
 TASKS_PATH='/home/kpov_judge/kpov-judge/tasks'
 GUESTFS_DEV_PREFIX = '/dev/'
 STATIC_DIR='/home/kpov_judge/kpov-judge/web/kpov_judge/static'
 JWT_SECRET='123423423423455gfssdvv'
+# remember this many checker results for identical resubmissions (0 to disable)
+CHECK_CACHE_SIZE=10000
+CHECK_CACHE_TTL=600
+# submission tokens looked up in the last TOKEN_CACHE_TTL seconds are not read
+# again (0 disables). Each server process has its own cache, so a token
+# rotated in another process or params changed by add_task.py may be used for
+# up to TOKEN_CACHE_TTL seconds.
+TOKEN_CACHE_SIZE=0
+TOKEN_CACHE_TTL=60
+# addresses or networks allowed to read /metrics and /cache_stats.json; both
+# only show the server process that answers the request
+STATS_ALLOW=['127.0.0.1', '::1']
+# store submitted results compressed ('zlib', 'zstd' or None), see compact_results.py;
+# 'zstd' needs the optional zstandard package, which is not in requirements.txt
+RESULTS_COMPRESSION='zlib'
+# compact_results.py --archive keeps the best and this many latest attempts in results
+RESULTS_KEEP_LAST=5
+# export request traces to TRACE_PATH: this fraction of all requests, and every
+# request taking at least TRACE_SLOW_SECONDS (None to disable)
+TRACE_SAMPLE_RATE=0.0
+TRACE_SLOW_SECONDS=2.0
+TRACE_PATH='/var/log/kpov_judge/traces.jsonl'
+# record anonymized params.json and results.json traffic for replay_traffic.py
+TRAFFIC_RECORD_PATH=None
+TRAFFIC_RECORD_SALT='change me'
+# compiled instruction templates are kept here across restarts (None for memory only),
+# and rendered instructions are cached for INSTRUCTIONS_CACHE_TTL seconds
+INSTRUCTIONS_BYTECODE_DIR=None
+INSTRUCTIONS_CACHE_SIZE=4096
+INSTRUCTIONS_CACHE_TTL=3600
+# serve disk images from the judge (checking the student and supporting resumed
+# downloads) instead of linking to STUDENT_DISK_URL; set USE_X_SENDFILE=True if
+# the front-end server supports X-Sendfile
+SERVE_STUDENT_DISKS=False
+STUDENT_DISK_DOWNLOADS=4
+BACKING_FILE_MAX_AGE=2592000
@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Read the dictionaries and function sources from a task.py without running
+# it. If the module does anything besides assigning literals and defining
+# functions, the values are taken from executing it, as before. Results are
+# cached on disk by the hash of the source.
+
+import ast
+import hashlib
+import marshal
+import os
+
+CACHE_DIR = os.path.expanduser('~/.cache/kpov_manifests')
+CACHE_VERSION = 3
+
+# module-level names read as literals
+LITERALS = ('instructions', 'computers', 'networks', 'params_meta', 'prepare_disks_per_computer',
+            'memoize_checks')
+
+def _function_source(lines, node):
+    # like inspect.getsource: whole lines, including decorators
+    start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+    return ''.join(lines[start-1:node.end_lineno])
+
+def _names(node):
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+def _is_static(node):
+    # True if running the statement cannot change the manifest names other
+    # than by assigning a literal to them
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return not node.decorator_list
+    if isinstance(node, ast.Expr):
+        # docstrings
+        return isinstance(node.value, ast.Constant)
+    if isinstance(node, ast.Assign):
+        targets = set().union(*map(_names, node.targets))
+        if targets & set(LITERALS):
+            return len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+        return not _names(node.value) & set(LITERALS) and \
+            not any(isinstance(n, ast.Call) for n in ast.walk(node.value))
+    return False
+
+def extract(source, filename='task.py', globals=None):
+    # return {'values': {name: literal}, 'functions': {name: source}};
+    # globals are used when the module has to be executed
+    if isinstance(source, bytes):
+        source = source.decode('utf-8')
+    tree = ast.parse(source, filename)
+    lines = source.splitlines(keepends=True)
+    values = {}
+    functions = {}
+    static = True
+    for node in tree.body:
+        static = static and _is_static(node)
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                and isinstance(node.targets[0], ast.Name) and node.targets[0].id in LITERALS:
+            try:
+                values[node.targets[0].id] = ast.literal_eval(node.value)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                # not a literal (e.g. {**other} or a set of lists); let exec
+                # evaluate the whole file
+                static = False
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions[node.name] = _function_source(lines, node)
+    if not static:
+        # the names are computed or modified (e.g. instructions['en'] = …,
+        # params_meta.update(…) or in an if block), so run the module as before
+        d = {}
+        exec(compile(source, filename, 'exec'), globals if globals is not None else {}, d)
+        values = {name: d[name] for name in LITERALS if name in d}
+    return {'values': values, 'functions': functions}
+
+def load(path, cache_dir=CACHE_DIR, globals=None):
+    with open(path, 'rb') as f:
+        source = f.read()
+    key = hashlib.sha256(source + b'\0' + str(CACHE_VERSION).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, key) if cache_dir else None
+    if cache_file:
+        try:
+            with open(cache_file, 'rb') as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    manifest = extract(source, path, globals)
+    if cache_file:
+        try:
+            data = marshal.dumps(manifest)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, cache_file)
+        except (OSError, ValueError):
+            # not everything produced by the fallback can be cached
+            pass
+    return manifest
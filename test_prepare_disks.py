@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import concurrent.futures
 import fcntl
 import glob
 import inspect
 import os
+import shlex
 import sys
+import tarfile
+import time
 import urllib.request
 
 import guestfs
@@ -13,101 +17,149 @@ import paramiko
 import yaml
 
 import kpov_util
-from test_task import http_auth, print_header, rlinput
+from test_task import http_auth, print_header, read_params, rlinput
 from util import write_default_config
 
+# large channel windows keep bulk transfers from stalling on acknowledgements
+SSH_WINDOW_SIZE = 64 * 1024 * 1024
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+# chunks requested at once when downloading; readv buffers them in memory
+TRANSFER_WINDOW = 32
+
 class SSHGuestFs:
+    # Operations go through one long-lived SFTP session where possible, and
+    # shell commands wait for their exit status, so everything runs in order.
     def __init__(self, hostname, username, password):
-        return_results = {}
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(hostname, username=username, password=password)
         self.conn = client
+        self._sftp = None
     def __del__(self):
         try:
+            if self._sftp is not None:
+                self._sftp.close()
             self.conn.close()
         except:
             pass
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = paramiko.SFTPClient.from_transport(
+                self.conn.get_transport(), window_size=SSH_WINDOW_SIZE)
+        return self._sftp
+    def _run(self, command):
+        stdin, stdout, stderr = self.conn.exec_command(command)
+        output = stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError('{}: {}'.format(command, stderr.read().decode(errors='replace').strip()))
+        return output.decode(errors='replace')
+    def _exists(self, path):
+        try:
+            self.sftp.lstat(path)
+            return True
+        except FileNotFoundError:
+            return False
     def chmod(self, mode, path):
-        self.conn.exec_command('chmod {} "{}"'.format(oct(mode), path))
+        self.sftp.chmod(path, mode)
     def chown(self, owner, group, path):
-        self.conn.exec_command('chown {}.{} "{}"'.format(str(owner), str(group), path))
+        if isinstance(owner, int) and isinstance(group, int):
+            self.sftp.chown(path, owner, group)
+        else:
+            self._run('chown {}:{} {}'.format(shlex.quote(str(owner)), shlex.quote(str(group)), shlex.quote(path)))
     def command(self, arguments):
-        self.conn.exec_command(arguments)
+        if not isinstance(arguments, str):
+            arguments = ' '.join(shlex.quote(a) for a in arguments)
+        return self._run(arguments)
     def copy_in(self, src, dest):
-        self.cp_r(src, dest)
+        # upload the local file or directory src into the remote directory
+        # dest as a single tar stream instead of one request per file
+        channel = self.conn.get_transport().open_session(window_size=SSH_WINDOW_SIZE)
+        channel.exec_command('tar -x --no-same-owner -f - -C {}'.format(shlex.quote(dest)))
+        with channel.makefile('wb', TRANSFER_CHUNK_SIZE) as stream:
+            with tarfile.open(fileobj=stream, mode='w|', bufsize=TRANSFER_CHUNK_SIZE) as tar:
+                tar.add(src, arcname=os.path.basename(os.path.normpath(src)))
+        channel.shutdown_write()
+        if channel.recv_exit_status() != 0:
+            raise RuntimeError('copy_in {} {}: {}'.format(src, dest,
+                channel.makefile_stderr('rb').read().decode(errors='replace').strip()))
+        channel.close()
     def cp(self, src, dest):
-        self.conn.exec_command('cp "{}" "{}"'.format(src, dest))
+        self._run('cp {} {}'.format(shlex.quote(src), shlex.quote(dest)))
     def cp_a(self, src, dest):
-        self.conn.exec_command('cp -a "{}" "{}"'.format(src, dest))
+        self._run('cp -a {} {}'.format(shlex.quote(src), shlex.quote(dest)))
     def cp_r(self, src, dest):
-        self.conn.exec_command('cp -r "{}" "{}"'.format(src, dest))
+        self._run('cp -r {} {}'.format(shlex.quote(src), shlex.quote(dest)))
     def dd(self, src, dest):
-        self.conn.exec_command('dd if="{}" of="{}"'.format(src, dest))
+        self._run('dd if={} of={}'.format(shlex.quote(src), shlex.quote(dest)))
     def df(self):
-        stdin, stdout, stderr = self.conn.exec_command('df')
-        return stdin.read()
+        return self._run('df')
     def download(self, remotefilename, filename):
-        stdin, stdout, stderr = self.conn.exec_command('dd if="{}"'.format(path))
-        with open(filename, 'w') as f:
-            data = stdin.read(4096)
-            while data:
-                f.write(data)
-                data = stdin.read(4096)
+        with self.sftp.file(remotefilename, mode='r') as f:
+            size = f.stat().st_size
+        self.download_offset(remotefilename, filename, 0, size)
     def download_offset (self, remotefilename, filename, offset, size):
-        stdin, stdout, stderr = self.conn.exec_command('dd bs=1 skip={} count={} if="{}"'.format(
-            offset, size ,path))
-        with open(filename, 'w') as f:
-            data = stdin.read(4096)
-            while data:
-                f.write(data)
-                data = stdin.read(4096)
+        # request a window of chunks at once and write each one as it arrives
+        chunks = [(o, min(TRANSFER_CHUNK_SIZE, offset + size - o))
+                  for o in range(offset, offset + size, TRANSFER_CHUNK_SIZE)]
+        with self.sftp.file(remotefilename, mode='r') as rf, \
+                open(filename, 'wb', buffering=0) as f:
+            for i in range(0, len(chunks), TRANSFER_WINDOW):
+                for data in rf.readv(chunks[i:i+TRANSFER_WINDOW]):
+                    f.write(data)
     def du(self, path):
-        stdin, stdout, stderr = self.conn.exec_command('du "{}"'.format(path))
-        return stdin.read()
+        return self._run('du {}'.format(shlex.quote(path)))
     def equal(self, file1, file2):
         pass
     def file(self, path):
-        stdin, stdout, stderr = self.conn.exec_command('file "{}"'.format(path))
-        return stdin.read()
+        return self._run('file {}'.format(shlex.quote(path)))
     def ln(self, target, linkname):
-        self.conn.exec_command('ln "{}" "{}"'.format(target, linkname))
+        self._run('ln {} {}'.format(shlex.quote(target), shlex.quote(linkname)))
     def ln_s(self, target, linkname):
-        self.conn.exec_command('ln -s "{}" "{}"'.format(target, linkname))
+        self.sftp.symlink(target, linkname)
     def ln_f(self, target, linkname):
-        self.conn.exec_command('ln -f "{}" "{}"'.format(target, linkname))
+        self._run('ln -f {} {}'.format(shlex.quote(target), shlex.quote(linkname)))
     def ln_sf(self, target, linkname):
-        self.conn.exec_command('ln -sf "{}" "{}"'.format(target, linkname))
+        if self._exists(linkname):
+            self.sftp.remove(linkname)
+        self.sftp.symlink(target, linkname)
     def getxattrs(self, path):
         pass
         #path = path)
         #stdin, stdout, stderr = self.conn.exec_command('du "{}"'.format(path))
         #return stdin.read()
     def mv (self, src, dest):
-        self.conn.exec_command('mv "{}" "{}"'.format(src, dest))
+        try:
+            self.sftp.posix_rename(src, dest)
+        except IOError:
+            # e.g. across filesystems
+            self._run('mv {} {}'.format(shlex.quote(src), shlex.quote(dest)))
     def mkdir (self, path):
-        self.conn.exec_command('mkdir -p "{}"'.format(path))
+        # like mkdir -p
+        parent = os.path.dirname(path.rstrip('/'))
+        if parent and parent != path and not self._exists(parent):
+            self.mkdir(parent)
+        if not self._exists(path):
+            self.sftp.mkdir(path)
+    def mkdir_p (self, path):
+        self.mkdir(path)
     def read_file (self, path):
-        sftp_client = self.conn.open_sftp()
-        f = sftp_client.file(path, mode='r', bufsize=-1)
-        s = f.read()
-        f.close()
-        return s
+        with self.sftp.file(path, mode='r', bufsize=-1) as f:
+            f.prefetch()
+            return f.read()
     def readdir (self, dir):
-        sftp_client = self.conn.open_sftp()
-        return sftp_client.listdir(path)
+        return self.sftp.listdir(dir)
     def readlink (self, path):
-        stdin, stdout, stderr = self.conn.exec_command('readlink "{}"'.format(path))
-        return stdin.read()
+        return self.sftp.readlink(path)
     def rename (self, oldpath, newpath):
         return self.mv(oldpath, newpath)
     def rm (self, path):
-        stdin, stdout, stderr = self.conn.exec_command('rm "{}"'.format(path))
+        self.sftp.remove(path)
     def rm_rf (self, path):
-        stdin, stdout, stderr = self.conn.exec_command('rm -rf "{}"'.format(path))
+        self._run('rm -rf {}'.format(shlex.quote(path)))
     def rmdir (self, path):
-        stdin, stdout, stderr = self.conn.exec_command('rmdir "{}"'.format(path))
+        self.sftp.rmdir(path)
     def touch (self, path):
         """Touch acts like the touch(1) command. It can be used to
         update the timestamps on a file, or, if the file does
@@ -117,7 +169,9 @@ class SSHGuestFs:
         on other file types such as directories, symbolic links,
         block special etc.
         """
-        self.conn.exec_command('touch "{}"'.format(path))
+        with self.sftp.file(path, mode='a'):
+            pass
+        self.sftp.utime(path, None)
     def setxattr (self, xattr, val, vallen, path):
         pass
     def write (self, path, content):
@@ -127,10 +181,11 @@ class SSHGuestFs:
         
         See also "g.write_append".
         """
-        sftp_client = self.conn.open_sftp()
-        f = sftp_client.file(path, mode='w', bufsize=-1)
-        f.write(content)
-        f.close()
+        with self.sftp.file(path, mode='w', bufsize=-1) as f:
+            # do not wait for each write to be acknowledged; close waits
+            # for all of them, so later operations see the whole file
+            f.set_pipelined(True)
+            f.write(content)
 
     def write_append (self, path, content):
         """This call appends "content" to the end of file "path".
@@ -138,10 +193,9 @@ class SSHGuestFs:
         
         See also "g.write".
         """
-        sftp_client = self.conn.open_sftp()
-        f = sftp_client.file(path, mode='a', bufsize=-1)
-        f.write(content)
-        f.close()
+        with self.sftp.file(path, mode='a', bufsize=-1) as f:
+            f.set_pipelined(True)
+            f.write(content)
 
  
 if __name__ == '__main__':
@@ -151,8 +205,7 @@ if __name__ == '__main__':
         print("The task name and params are read from ~/.kpov_params.yaml")
 
     yaml_config_file = os.path.expanduser("~/.kpov_params.yaml")
-    with open(yaml_config_file) as f:
-        params = yaml.load(f)
+    params = read_params(yaml_config_file)
 
     task_name = params['task_name']
     task_params = params.get('task_params', {}).get(task_name)
@@ -175,7 +228,6 @@ if __name__ == '__main__':
         print(e)
         exit(1)
 
-    templates = dict()
     sshguestfs_params = params.get('sshguestfs_params', dict())
     task_sshguestfs_params = sshguestfs_params.get(task_name, dict())
     for computer_name, computer in computers.items():
@@ -184,19 +236,61 @@ if __name__ == '__main__':
         for k in ['hostname', 'username', 'password']:
             comp_params[k] = rlinput(f'{k.title()}: ',
                     prefill=comp_params.get(k, ''))
-        comp_connection = None
-        try:
-            comp_connection = SSHGuestFs(**comp_params)
-            task_sshguestfs_params[computer_name] = comp_params
-        except Exception as e:
-            print(f'Could not connect to {computer_name}: {e}')
-            sys.exit(2)
-        for disk in computer['disks']:
-            disk_name = disk['name']
-            templates[disk_name] = comp_connection
+        task_sshguestfs_params[computer_name] = comp_params
+
+    # log in to all computers at once
+    def connect(computer_name):
+        start = time.perf_counter()
+        connection = SSHGuestFs(**task_sshguestfs_params[computer_name])
+        return connection, time.perf_counter() - start
+
+    print_header('Connecting')
+    connections = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(computers) or 1) as executor:
+        futures = {name: executor.submit(connect, name) for name in computers}
+        for computer_name, future in futures.items():
+            try:
+                connections[computer_name], elapsed = future.result()
+                print(f'{computer_name}: connected in {elapsed:.2f} s')
+            except Exception as e:
+                print(f'Could not connect to {computer_name}: {e}')
+                sys.exit(2)
+
+    computer_templates = {}
+    templates = dict()
+    for computer_name, computer in computers.items():
+        computer_templates[computer_name] = {
+            disk['name']: connections[computer_name] for disk in computer['disks']}
+        templates.update(computer_templates[computer_name])
+
     sshguestfs_params[task_name] = task_sshguestfs_params
     params['sshguestfs_params'] = sshguestfs_params
     with open(yaml_config_file, 'w') as f:
         # print "dumping", params
         yaml.dump(params, f)
-    prepare_disks(templates, task_params, params)
+
+    # Tasks can set prepare_disks_per_computer = True if prepare_disks only
+    # touches the disks it is given; it is then called for every computer
+    # in parallel with just that computer's disks.
+    print_header('Preparing disks')
+    start = time.perf_counter()
+    if d.get('prepare_disks_per_computer', False):
+        def prepare(computer_name):
+            start = time.perf_counter()
+            prepare_disks(computer_templates[computer_name], task_params, params)
+            return time.perf_counter() - start
+
+        failed = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(computers) or 1) as executor:
+            futures = {name: executor.submit(prepare, name) for name in computers}
+            for computer_name, future in futures.items():
+                try:
+                    print(f'{computer_name}: prepared in {future.result():.2f} s')
+                except Exception as e:
+                    print(f'{computer_name}: prepare_disks failed: {e}')
+                    failed = True
+        if failed:
+            sys.exit(3)
+    else:
+        prepare_disks(templates, task_params, params)
+    print(f'done in {time.perf_counter() - start:.2f} s')
@@ -1,34 +1,72 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import time
+_start = time.perf_counter()
+
 import argparse
 import collections
-import getpass
-import inspect
+import importlib
 import io
 import json
-import locale
 import os
-import random
-import readline
 import sys
-import urllib.request
-
-import yaml
-import kpov_util
-
-locale.setlocale(locale.LC_ALL, ['C', 'utf8'])
-readline.set_completer_delims(readline.get_completer_delims().replace('/', ''))
-readline.parse_and_bind('tab: complete')
+import urllib.parse
 
 TASK_URL = "file://" + os.getcwd() + '/tasks'
 PARAMS_FILE = os.path.expanduser("~/.kpov_params.yaml")
+CACHE_DIR = os.path.expanduser("~/.kpov_cache")
+# seconds to wait for the server before using the cached task
+FETCH_TIMEOUT = 10
 DEFAULT_LANGUAGE = 'si'
 
+URL_META = {
+    'task_url': {'descriptions': {'si': 'URL z nalogami', 'en': 'Root URL for all tasks'}}
+}
+TASK_NAME_META = {
+    'task_name': {'descriptions': {'si': 'Ime naloge', 'en': 'Task name'}}
+}
+
+# startup timings for --profile-startup as (what, seconds)
+timings = [('startup imports', time.perf_counter() - _start)]
+_phase_start = time.perf_counter()
+
+def phase(name):
+    global _phase_start
+    now = time.perf_counter()
+    timings.append((name, now - _phase_start))
+    _phase_start = now
+
+def lazy_import(name):
+    # heavy modules are only imported when needed, which keeps startup fast
+    if name in sys.modules:
+        return sys.modules[name]
+    t = time.perf_counter()
+    module = importlib.import_module(name)
+    timings.append(('  import ' + name, time.perf_counter() - t))
+    return module
+
+def print_timings(out=sys.stderr):
+    print('> Startup profile', file=out)
+    for name, t in timings:
+        print('{:<24} {:8.1f} ms'.format(name, t * 1000), file=out)
+    total = sum(t for name, t in timings if not name.startswith(' '))
+    print('{:<24} {:8.1f} ms'.format('total', total * 1000), file=out)
+
+_readline = None
+def init_readline():
+    global _readline
+    if _readline is None:
+        _readline = lazy_import('readline')
+        _readline.set_completer_delims(_readline.get_completer_delims().replace('/', ''))
+        _readline.parse_and_bind('tab: complete')
+    return _readline
+
 def print_header(title, spacing=1):
     print('\n'*spacing + '> {}'.format(title))
 
 def rlinput(prompt, prefill=''):
+    readline = init_readline()
     readline.set_startup_hook(lambda: readline.insert_text(prefill))
     try:
         return input(prompt)
@@ -49,7 +87,7 @@ def get_params(params, params_meta, language=None):
         if meta.get('w', True):
             try:
                 if meta.get('masked', False):
-                    s = getpass.getpass('{}: '.format(description))
+                    s = lazy_import('getpass').getpass('{}: '.format(description))
                 else:
                     s = rlinput('{}: '.format(description), params.get(name, ''))
                 params[name] = s
@@ -63,55 +101,199 @@ def add_meta_to_argparser(argparser, meta, defaults={}):
     language = defaults.get('language', DEFAULT_LANGUAGE)
     for k, v in meta.items():
         try:
-            desc = v['descriptions'][language].encode("utf-8")
+            desc = v['descriptions'][language]
         except:
             desc = k
         argparser.add_argument('--'+k, nargs='?', type=str, help=desc,
             default=defaults.get(k, None))
 
+def read_params(filename):
+    # params are written with yaml.dump and may contain OrderedDicts, which
+    # safe_load cannot read
+    yaml = lazy_import('yaml')
+    with open(filename) as f:
+        return yaml.load(f, Loader=yaml.Loader) or {}
+
 def load_params(filename):
     try:
-        return yaml.load(open(filename))
+        return read_params(filename)
     except:
         return {}
 
-def locate_task(params, argparser, quiet=False):
+def save_params(filename, params, saved):
+    # only write when something changed, and never leave a truncated file
+    if params == saved:
+        return False
+    yaml = lazy_import('yaml')
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        yaml.dump(params, f)
+    os.replace(tmp, filename)
+    return True
+
+def locate_task(params, args, quiet=False):
     # first the URL where all tasks are stored
-    url_meta = {
-        'task_url': {'descriptions': {'si': 'URL z nalogami', 'en': 'Root URL for all tasks'}}
-    }
-    if 'task_url' not in params:
+    if args.task_url is not None:
+        params['task_url'] = args.task_url
+    elif 'task_url' not in params:
         params['task_url'] = TASK_URL
-    add_meta_to_argparser(argparser, meta=url_meta, defaults=params)
-    args, unknown_args = argparser.parse_known_args()
-    params['task_url'] = args.task_url
     if not quiet:
         print_header('Task', spacing=0)
-        params = get_params(params, url_meta)
+        params = get_params(params, URL_META)
 
     # and finally, the name of the task
-    fetch_params_meta = collections.OrderedDict({'task_name': {'descriptions': {'si': 'Ime naloge', 'en': 'Task name'}}})
-    add_meta_to_argparser(argparser, meta=fetch_params_meta, defaults=params)
-    args, unknown_args = argparser.parse_known_args()
-    # update params with the now known args
-    for k, v in fetch_params_meta.items():
-        params[k] = vars(args).get(k, params.get(k, None))
+    if args.task_name is not None:
+        params['task_name'] = args.task_name
+    else:
+        params.setdefault('task_name', None)
     if not quiet:
-        params = get_params(params, fetch_params_meta)
+        params = get_params(params, TASK_NAME_META)
     return params
 
 def http_auth(url, username, password):
+    lazy_import('urllib.request')
     password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
     password_mgr.add_password(None, url, username, password)
     handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
     opener = urllib.request.build_opener(handler)
     urllib.request.install_opener(opener) # now all calls to urlopen use our opener
 
-def load_task(stream):
-    # the stream should definitions for the functions task(…),
-    # task_check and gen_params, and a dictionary params_meta
+def _write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def fetch_task(url, cache_dir=CACHE_DIR):
+    # return the compiled task source from url; http(s) sources are cached
+    # together with their bytecode and revalidated with If-None-Match
+    if url.startswith('file://'):
+        with open(urllib.parse.unquote(urllib.parse.urlsplit(url).path), 'rb') as f:
+            source = f.read()
+    elif not url.startswith('http'):
+        source = lazy_import('urllib.request').urlopen(url).read()
+    else:
+        return fetch_task_cached(url, cache_dir)
+    if not source:
+        raise Exception('no such task: {}'.format(url))
+    return compile(source, 'task.py', 'exec')
+
+def fetch_task_cached(url, cache_dir=CACHE_DIR):
+    hashlib = lazy_import('hashlib')
+    importlib_util = lazy_import('importlib.util')
+    marshal = lazy_import('marshal')
+    lazy_import('urllib.request')
+
+    key = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+    try:
+        with open(key + '.json') as f:
+            cached = json.load(f)
+        if cached['magic'] != importlib_util.MAGIC_NUMBER.hex():
+            raise ValueError('stale bytecode')
+    except Exception:
+        cached = None
+
+    def load_cached():
+        with open(key + '.pyc', 'rb') as f:
+            return marshal.load(f)
+
+    req = urllib.request.Request(url)
+    if cached and cached.get('etag'):
+        req.add_header('If-None-Match', cached['etag'])
+    try:
+        with urllib.request.urlopen(req, timeout=FETCH_TIMEOUT) as response:
+            source = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            return load_cached()
+        raise
+    except OSError as e:
+        # offline or the server does not answer (URLError and socket.timeout
+        # are both OSErrors), use whatever we have
+        if cached:
+            print('using cached task ({})'.format(getattr(e, 'reason', e)))
+            return load_cached()
+        raise
+
+    if not source:
+        raise Exception('no such task: {}'.format(url))
+    code = compile(source, 'task.py', 'exec')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_atomic(key + '.py', source)
+        _write_atomic(key + '.pyc', marshal.dumps(code))
+        _write_atomic(key + '.json', json.dumps({
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'magic': importlib_util.MAGIC_NUMBER.hex(),
+        }).encode())
+    except OSError:
+        pass
+    return code
+
+def fetch_manifest(url, token=None):
+    # {file name: sha256} from a SHA256SUMS file
+    data = None
+    if token and url.startswith('http'):
+        data = urllib.parse.urlencode({'token': token}).encode()
+    manifest = {}
+    with lazy_import('urllib.request').urlopen(url, data=data) as response:
+        for line in io.TextIOWrapper(response):
+            digest, _, fname = line.strip().partition('  ')
+            if fname:
+                manifest[fname] = digest
+    return manifest
+
+def verify_images(paths, manifest):
+    # images are hashed in parallel, the same way the server hashes them, and
+    # the digests are kept in <image>.sha256 until the image changes; returns
+    # True if all match
+    futures = lazy_import('concurrent.futures')
+    disk_checksums = lazy_import('disk_checksums')
+    ok = True
+    with futures.ThreadPoolExecutor() as pool:
+        for path, future in [(path, pool.submit(disk_checksums.cached_digest, path)) for path in paths]:
+            expected = manifest.get(os.path.basename(path))
+            try:
+                digest = future.result()
+            except OSError as e:
+                status = e.strerror
+            else:
+                if expected is None:
+                    status = 'not in manifest'
+                elif digest != expected:
+                    status = 'CORRUPT, download it again'
+                else:
+                    status = 'OK'
+            ok = ok and status == 'OK'
+            print('{}: {}'.format(path, status))
+    return ok
+
+# modules that used to be imported at startup; tasks run with this module's
+# globals and may use them without importing them
+TASK_MODULES = {'getpass', 'hashlib', 'inspect', 'kpov_util', 'marshal', 'random', 'readline',
+                'urllib', 'yaml'}
+
+def _global_names(code):
+    # names the code or any function defined in it may look up as globals
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            names |= _global_names(const)
+    return names
+
+def load_task(code):
+    # the code should define the functions task(…),
+    # task_check and gen_params, and a dictionary params_meta;
+    # tasks may use kpov_util without importing it
+    for name in TASK_MODULES & _global_names(code):
+        if name == 'urllib':
+            # urllib itself is always imported, urllib.request is not
+            lazy_import('urllib.request')
+        else:
+            globals()[name] = lazy_import(name)
     d = {}
-    exec(compile(source, 'task.py', 'exec'), globals(), d)
+    exec(code, globals(), d)
     return d['task'], d['task_check'], d['params_meta'], d['gen_params']
 
 
@@ -127,37 +309,49 @@ if __name__ == '__main__':
         help='generate initial values for the task parameters')
     argparser.add_argument('-pf', '--params_file', nargs='?', default=PARAMS_FILE,
         help='a local file with saved param values')
-    basic_args, unknown_args = argparser.parse_known_args()
-
-    # get default parameters including language
-    params = load_params(basic_args.params_file)
     argparser.add_argument('-l', '--language', nargs='?',
-        default=params.get('language', DEFAULT_LANGUAGE),
-        help='the language used')
+        help='the language used (default: {})'.format(DEFAULT_LANGUAGE))
+    argparser.add_argument('--profile-startup', action='store_true',
+        help='print how long each startup phase took')
+    argparser.add_argument('--verify-image', nargs='+', metavar='IMAGE',
+        help='check downloaded disk images against the published checksums')
+    add_meta_to_argparser(argparser, meta=URL_META)
+    add_meta_to_argparser(argparser, meta=TASK_NAME_META)
     basic_args, unknown_args = argparser.parse_known_args()
-    params['language'] = basic_args.language
+    phase('parse arguments')
 
     if basic_args.help:
         argparser.print_help()
         exit(0)
 
+    # get default parameters including language
+    params = load_params(basic_args.params_file)
+    saved_params = lazy_import('copy').deepcopy(params)
+    if basic_args.language is not None:
+        params['language'] = basic_args.language
+    else:
+        params.setdefault('language', DEFAULT_LANGUAGE)
+    phase('load params')
+
+    locale = lazy_import('locale')
+    locale.setlocale(locale.LC_ALL, ['C', 'utf8'])
+
     # continue with the parameters needed to get the task
-    params = locate_task(params, argparser, quiet=basic_args.quiet)
+    params = locate_task(params, basic_args, quiet=basic_args.quiet)
+    phase('locate task')
     # TODO: if the task name is missing or invalid, try to get a list of tasks 
     # get task source and generate params if neccessarry
     try:
         task_url = params['task_url']
         task_name = params['task_name']
 
-        source = urllib.request.urlopen("{task_url}/{task_name}/task.py".format(**params)).read()
-        if not source:
-            raise Exception('no such task: {}'.format(task_name))
-        task, task_check, task_params_meta, gen_params = load_task(source)
+        code = fetch_task("{task_url}/{task_name}/task.py".format(**params))
+        task, task_check, task_params_meta, gen_params = load_task(code)
     except Exception as e:
         print(e)
-        with open(basic_args.params_file, 'w') as f:
-            yaml.dump(params, f)
+        save_params(basic_args.params_file, params, saved_params)
         exit(1)
+    phase('fetch task')
 
     # get stored task parameters
     params['task_params'] = params.get('task_params', {})
@@ -203,7 +397,18 @@ if __name__ == '__main__':
                 print(ex)
     else:
         # use system username to generate parameters
-        params['username'] = getpass.getuser()
+        params['username'] = lazy_import('getpass').getuser()
+    phase('token')
+
+    if basic_args.verify_image:
+        save_params(basic_args.params_file, params, saved_params)
+        try:
+            manifest = fetch_manifest('{task_url}/{task_name}/disks/SHA256SUMS'.format(**params),
+                                      tokens.get(task_name))
+        except Exception as e:
+            print('could not get checksums: {}'.format(e))
+            exit(1)
+        exit(0 if verify_images(basic_args.verify_image, manifest) else 1)
 
     if basic_args.generate_params:
 	#prejema lahko samo stringe in ne številk (potrebno je str(int)
@@ -211,9 +416,9 @@ if __name__ == '__main__':
         task_params.update(gen_params(params['username'], task_params_meta))
         # print ("params after: {} {}".format(params, task_params))
 
-    task_argparser = argparse.ArgumentParser(parents=[argparser], conflict_handler='resolve', add_help=True)
-    add_meta_to_argparser(task_argparser, task_params_meta, defaults=task_params)
-    args = vars(task_argparser.parse_args())
+    # the same parser, now also with the task parameters
+    add_meta_to_argparser(argparser, task_params_meta, defaults=task_params)
+    args = vars(argparser.parse_args())
     for k in task_params_meta:
         if args.get(k):
             task_params[k] = args[k]
@@ -222,18 +427,26 @@ if __name__ == '__main__':
         task_params = get_params(task_params, task_params_meta, language=params['language'])
 
     public_params = {}
-    for k in inspect.getargs(task.__code__)[0]:
+    for k in task.__code__.co_varnames[:task.__code__.co_argcount]:
         public_params[k] = task_params[k]
     params['task_params'][params['task_name']] = task_params
+    phase('task params')
 
     # save parameters for the next run
-    with open(basic_args.params_file, 'w') as f:
-        yaml.dump(params, f)
+    save_params(basic_args.params_file, params, saved_params)
+    phase('save params')
+    if basic_args.profile_startup:
+        print_timings()
 
     try:
         print_header('Results', spacing=0 if basic_args.quiet else 1)
         print('Running task... ', end='', flush=True)
-        task_result = task(**public_params)
+        try:
+            task_result = task(**public_params)
+        finally:
+            # ssh sessions are reused between checks only within one run
+            if 'kpov_util' in sys.modules:
+                sys.modules['kpov_util'].ssh_close_all()
         print('checking task... ', end='', flush=True)
         task_params['token'] = tokens.get(task_name, '') # hack to avoid changing task_check signature
         score, hints = task_check(task_result, task_params)
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import http.server
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import test_task
+
+SOURCE = b'x = 42\n'
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('ETag', '"1"')
+        self.end_headers()
+        self.wfile.write(SOURCE)
+
+    def log_message(self, *args):
+        pass
+
+class FetchTaskTest(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.cache_dir = d.name
+
+    def run_code(self, code):
+        d = {}
+        exec(code, {}, d)
+        return d
+
+    def test_unresponsive_server(self):
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.addCleanup(server.server_close)
+        url = 'http://127.0.0.1:{}/task.py'.format(server.server_port)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        code = test_task.fetch_task_cached(url, cache_dir=self.cache_dir)
+        thread.join()
+        self.assertEqual(self.run_code(code), {'x': 42})
+
+        # the server accepts the connection but never answers
+        with mock.patch.object(test_task, 'FETCH_TIMEOUT', 0.2), mock.patch('builtins.print'):
+            code = test_task.fetch_task_cached(url, cache_dir=self.cache_dir)
+            self.assertEqual(self.run_code(code), {'x': 42})
+            with self.assertRaises(OSError):
+                test_task.fetch_task_cached(url + '?other', cache_dir=self.cache_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,347 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# create_opstack.py against fake keystone, quantum and nova clients and a
+# small in-memory replacement for the database
+
+import copy
+import io
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+try:
+    import pymongo
+except ImportError:
+    pymongo = None
+
+if pymongo is not None:
+    try:
+        import settings
+    except ImportError:
+        # create_opstack only reads settings in main and the client factories
+        sys.modules['settings'] = types.ModuleType('settings')
+    import create_opstack
+
+class Resource:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class TimedOut(Exception):
+    pass
+
+class FakeAPI:
+    # failures[method] calls fail; with created_before_failure the resource is
+    # created before the call fails, like a request that timed out on the client
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.created_before_failure = True
+        self.calls = []
+
+    def call(self, method, create):
+        with self.lock:
+            self.calls.append(method)
+            fail = self.failures.get(method, 0)
+            if fail:
+                self.failures[method] = fail - 1
+                if self.created_before_failure:
+                    create()
+                raise TimedOut(method)
+            return create()
+
+class FakeServers(FakeAPI):
+    def __init__(self):
+        super().__init__()
+        self.items = []
+
+    def create(self, name, **kwargs):
+        def create():
+            server = Resource(id='server{}'.format(len(self.items)), name=name, hints=kwargs.get('scheduler_hints'),
+                              **{'OS-EXT-SRV-ATTR:host': 'host1'})
+            self.items.append(server)
+            return server
+        return self.call('servers.create', create)
+
+    def findall(self, name):
+        with self.lock:
+            return [s for s in self.items if s.name == name]
+
+class FakeTenants(FakeAPI):
+    def __init__(self):
+        super().__init__()
+        self.items = []
+
+    def create(self, tenant_name):
+        def create():
+            tenant = Resource(id='tenant{}'.format(len(self.items)), name=tenant_name)
+            self.items.append(tenant)
+            return tenant
+        return self.call('tenants.create', create)
+
+    def findall(self, name):
+        return [t for t in self.items if t.name == name]
+
+class FakeRoles(FakeAPI):
+    def __init__(self):
+        super().__init__()
+        self.assigned = []
+
+    def find(self, name):
+        return Resource(id='role-' + name, name=name)
+
+    def roles_for_user(self, user, project):
+        return [r for u, r, p in self.assigned if u.id == user.id and p == project]
+
+    def add_user_role(self, user, role, project):
+        def create():
+            if role in self.roles_for_user(user, project):
+                raise ValueError('role already assigned')
+            self.assigned.append((user, role, project))
+        return self.call('roles.add_user_role', create)
+
+class FakeKeystone:
+    def __init__(self):
+        self.tenants = FakeTenants()
+        self.roles = FakeRoles()
+        self.users = Resource(find=lambda name: Resource(id='user-' + name, name=name))
+
+class FakeQuantum(FakeAPI):
+    def __init__(self):
+        super().__init__()
+        self.networks = []
+        self.subnets = []
+
+    def create_network(self, body):
+        def create():
+            network = dict(body['network'], id='net{}'.format(len(self.networks)))
+            self.networks.append(network)
+            return {'network': network}
+        return self.call('create_network', create)
+
+    def list_networks(self, name, tenant_id):
+        return {'networks': [n for n in self.networks if n['name'] == name and n['tenant_id'] == tenant_id]}
+
+    def create_subnet(self, body):
+        def create():
+            subnet = dict(body['subnet'], id='subnet{}'.format(len(self.subnets)))
+            self.subnets.append(subnet)
+            return {'subnet': subnet}
+        return self.call('create_subnet', create)
+
+    def list_subnets(self, name, network_id):
+        return {'subnets': [s for s in self.subnets if s['name'] == name and s['network_id'] == network_id]}
+
+class FakeNova:
+    def __init__(self):
+        self.servers = FakeServers()
+        self.images = Resource(find=lambda name: Resource(id='image-' + name))
+        self.flavors = Resource(find=lambda name: Resource(id='flavor-' + name))
+
+class FakeCollection:
+    # the part of the pymongo collection API create_opstack uses
+    def __init__(self):
+        self.docs = []
+        self.requests = []
+
+    def _matches(self, doc, query):
+        for k, v in query.items():
+            if isinstance(v, dict) and '$ne' in v:
+                if doc.get(k) == v['$ne']:
+                    return False
+            elif doc.get(k) != v:
+                return False
+        return True
+
+    def find(self, query=None, projection=None):
+        return [copy.deepcopy(d) for d in self.docs if self._matches(d, query or {})]
+
+    def find_one(self, query):
+        docs = self.find(query)
+        return docs[0] if docs else None
+
+    def insert_many(self, docs):
+        self.docs.extend(copy.deepcopy(docs))
+
+    def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                break
+        else:
+            doc = dict(query)
+            self.docs.append(doc)
+        for k, v in update['$set'].items():
+            d = doc
+            path = k.split('.')
+            for p in path[:-1]:
+                d = d.setdefault(p, {})
+            d[path[-1]] = copy.deepcopy(v)
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests.extend(requests)
+
+class FakeDB(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+@unittest.skipIf(pymongo is None, 'pymongo is not installed')
+class CreateOnceTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry(self):
+        fn = mock.Mock(side_effect=[TimedOut(), TimedOut(), 'ok'])
+        self.assertEqual(create_opstack.retry(fn, 1, x=2), 'ok')
+        self.assertEqual(fn.call_count, 3)
+        fn.assert_called_with(1, x=2)
+        fn = mock.Mock(side_effect=TimedOut())
+        with self.assertRaises(TimedOut):
+            create_opstack.retry(fn, attempts=3)
+        self.assertEqual(fn.call_count, 3)
+
+    def test_existing_is_not_created(self):
+        create = mock.Mock()
+        self.assertEqual(create_opstack.create_once(create, lambda: 'existing'), 'existing')
+        create.assert_not_called()
+
+    def test_timed_out_create_is_adopted(self):
+        tenants = FakeTenants()
+        tenants.failures['tenants.create'] = 1
+        tenant = create_opstack.create_once(lambda: tenants.create(tenant_name='p'),
+                                            lambda: create_opstack.first(tenants.findall(name='p')))
+        self.assertEqual(len(tenants.items), 1)
+        self.assertIs(tenant, tenants.items[0])
+        self.assertEqual(tenants.calls, ['tenants.create'])
+
+    def test_failed_create_is_retried(self):
+        tenants = FakeTenants()
+        tenants.created_before_failure = False
+        tenants.failures['tenants.create'] = 2
+        create_opstack.create_once(lambda: tenants.create(tenant_name='p'),
+                                   lambda: create_opstack.first(tenants.findall(name='p')))
+        self.assertEqual(len(tenants.items), 1)
+        self.assertEqual(len(tenants.calls), 3)
+        tenants.failures['tenants.create'] = 3
+        with self.assertRaises(TimedOut):
+            create_opstack.create_once(lambda: tenants.create(tenant_name='q'),
+                                       lambda: create_opstack.first(tenants.findall(name='q')),
+                                       attempts=3)
+        self.assertEqual(len(tenants.items), 1)
+
+@unittest.skipIf(pymongo is None, 'pymongo is not installed')
+class ProvisionerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = FakeDB()
+        self.db.networks.insert_many([
+            {'task_id': 'task', 'name': 'net1', 'public': False},
+            {'task_id': 'task', 'name': 'net2', 'public': True},
+        ])
+        self.db.computers_meta.insert_many([
+            {'task_id': 'task', 'name': name, 'image': 'image', 'flavor': 'small',
+             'network_interfaces': [{'network': 'net1'}, {'network': 'net2'}]}
+            for name in ('a', 'b', 'c')
+        ])
+        self.kc = FakeKeystone()
+        self.qc = FakeQuantum()
+        self.nc = FakeNova()
+
+    def provisioner(self):
+        p = create_opstack.Provisioner(self.db, self.kc,
+            quantum_client=lambda tenant_name: self.qc,
+            nova_client=lambda tenant_name: self.nc, max_workers=4)
+        self.addCleanup(p.api_pool.shutdown)
+        return p
+
+    def assertProvisioned(self):
+        self.assertEqual(len(self.kc.tenants.items), 1)
+        self.assertEqual(sorted(n['name'] for n in self.qc.networks), ['net1', 'net2'])
+        self.assertEqual(len(self.qc.subnets), 2)
+        self.assertEqual(sorted(s.name for s in self.nc.servers.items),
+                         ['student-task-a', 'student-task-b', 'student-task-c'])
+        self.assertEqual(sorted(r.name for u, r, p in self.kc.roles.assigned), ['Member', 'admin'])
+        state = self.db.openstack_projects.find_one({'task_id': 'task', 'student_id': 'student'})
+        self.assertTrue(state['done'])
+        self.assertEqual(state['project_id'], 'tenant0')
+        self.assertEqual(sorted(state['networks']), ['net1', 'net2'])
+        servers = {s.name: s.id for s in self.nc.servers.items}
+        self.assertEqual({name: i['id'] for name, i in state['instances'].items()},
+                         {name: servers['student-task-' + name] for name in 'abc'})
+        return state
+
+    def test_provision(self):
+        p = self.provisioner()
+        self.assertEqual(p.provision_all([('task', 'student')], out=io.StringIO()), [])
+        self.assertProvisioned()
+        # the other servers are placed next to the first one
+        first = self.nc.servers.findall(name='student-task-a')[0]
+        self.assertIsNone(first.hints)
+        for s in self.nc.servers.items:
+            if s is not first:
+                self.assertEqual(s.hints, {'same_host': [first.id]})
+        written = {c: len(self.db[c].requests) for c in ('student_networks', 'student_computers', 'student_tasks')}
+        self.assertEqual(written, {'student_networks': 2, 'student_computers': 3, 'student_tasks': 1})
+
+    def test_timeouts(self):
+        # every create times out once after creating the resource
+        self.kc.tenants.failures['tenants.create'] = 1
+        self.kc.roles.failures['roles.add_user_role'] = 2
+        self.qc.failures = {'create_network': 2, 'create_subnet': 2}
+        self.nc.servers.failures['servers.create'] = 3
+        self.provisioner().provision('task', 'student')
+        self.assertProvisioned()
+
+    def test_failure_and_resume(self):
+        self.nc.servers.created_before_failure = False
+        self.nc.servers.failures['servers.create'] = 1000
+        p = self.provisioner()
+        self.assertEqual(p.provision_all([('task', 'student')], out=io.StringIO()),
+                         [('task', 'student')])
+        state = self.db.openstack_projects.find_one({'task_id': 'task', 'student_id': 'student'})
+        self.assertNotIn('done', state)
+        self.assertTrue(state['admin_role'])
+        self.assertEqual(sorted(state['networks']), ['net1', 'net2'])
+        self.assertEqual(state.get('instances', {}), {})
+        self.assertEqual(self.db.student_tasks.requests, [])
+        self.assertEqual(create_opstack.unfinished_projects(self.db), [('task', 'student')])
+
+        # the finished steps are not repeated
+        self.nc.servers.failures.clear()
+        self.kc.tenants.calls.clear()
+        self.qc.calls.clear()
+        self.provisioner().provision('task', 'student')
+        self.assertProvisioned()
+        self.assertEqual(self.kc.tenants.calls, [])
+        self.assertEqual(self.qc.calls, [])
+        self.assertEqual(self.kc.roles.calls, ['roles.add_user_role'] * 2)
+
+    def test_resume_after_crash(self):
+        # resources created before the state was written are adopted
+        self.kc.tenants.create(tenant_name='student-task')
+        self.nc.servers.create(name='student-task-b')
+        self.db.openstack_projects.update_one({'task_id': 'task', 'student_id': 'student'},
+                                              {'$set': {'project_id': 'tenant0'}}, upsert=True)
+        self.qc.create_network({'network': {'name': 'net2', 'tenant_id': 'tenant0'}})
+        self.provisioner().provision('task', 'student')
+        self.assertProvisioned()
+
+    def test_done(self):
+        self.provisioner().provision('task', 'student')
+        self.kc.tenants.calls.clear()
+        p = self.provisioner()
+        p.quantum_client = p.nova_client = mock.Mock(side_effect=AssertionError('client used'))
+        p.provision('task', 'student')
+        self.assertEqual(self.kc.tenants.calls, [])
+        self.assertEqual(len(p.writes['student_computers']), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import collections
+import os
+import tempfile
+import unittest
+
+import test_task
+
+class ParamsFileTest(unittest.TestCase):
+    def test_round_trip(self):
+        # gen_params may return OrderedDicts, which yaml.dump writes with
+        # python tags
+        params = {
+            'task_name': 'task',
+            'task_params': {'task': collections.OrderedDict([('IP', '10.0.0.1'), ('NAME', 'x')])},
+            'tokens': {'task': 'abc'},
+        }
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'params.yaml')
+            self.assertTrue(test_task.save_params(filename, params, {}))
+            self.assertEqual(test_task.read_params(filename), params)
+            self.assertEqual(test_task.load_params(filename), params)
+            self.assertFalse(test_task.save_params(filename, params, params))
+
+    def test_missing_file(self):
+        self.assertEqual(test_task.load_params('/nonexistent/params.yaml'), {})
+        with self.assertRaises(OSError):
+            test_task.read_params('/nonexistent/params.yaml')
+
+if __name__ == '__main__':
+    unittest.main()
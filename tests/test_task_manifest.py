@@ -0,0 +1,24 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import unittest
+
+import task_manifest
+
+class ExtractTest(unittest.TestCase):
+    def test_literals(self):
+        source = "params_meta = {'IP': {'public': True}}\ndef task(IP):\n    return IP\n"
+        manifest = task_manifest.extract(source)
+        self.assertEqual(manifest['values'], {'params_meta': {'IP': {'public': True}}})
+        self.assertIn('def task(IP):', manifest['functions']['task'])
+
+    def test_not_literals(self):
+        # the file is run instead
+        sources = [
+            "base = {'A': 1}\ncomputers = dict(base)\n",
+            "computers = {[1]: 2} if False else {'A': 1}\n",
+        ]
+        for source in sources:
+            self.assertEqual(task_manifest.extract(source)['values'], {'computers': {'A': 1}}, source)
+
+if __name__ == '__main__':
+    unittest.main()
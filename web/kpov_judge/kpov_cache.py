@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import collections
+import threading
+import time
+
+class TTLCache:
+    # Least recently used entries are dropped when there are more than
+    # maxsize of them, and entries older than ttl seconds are never returned.
+    # A maxsize of 0 disables the cache.
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
@@ -1,15 +1,40 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import pygraphviz as pgv
+from xml.sax.saxutils import escape, quoteattr
+
+# small setups are drawn directly, larger ones are left to graphviz
+MAX_NATIVE_NODES = 12
+
+ICON_SIZES = {
+    'computer': (120, 140),
+    'drive-harddisk': (48, 60),
+    'internet': (72, 80),
+}
 
 def draw_setup(computers, networks, destination=None,
                icon_prefix = '../../../static/icons/',
                format='svg', icon_path = '', icon_suffix = None):
+    if format == 'svg' and len(computers) + len(networks) <= MAX_NATIVE_NODES:
+        if icon_suffix is None:
+            icon_suffix = format
+        svg = draw_setup_svg(computers, networks, icon_prefix, '.' + icon_suffix)
+        if destination is None:
+            return svg
+        with open(destination, 'wb') as f:
+            f.write(svg)
+        return None
+    return draw_setup_graphviz(computers, networks, destination=destination,
+        icon_prefix=icon_prefix, format=format, icon_path=icon_path, icon_suffix=icon_suffix)
+
+def draw_setup_graphviz(computers, networks, destination=None,
+               icon_prefix = '../../../static/icons/',
+               format='svg', icon_path = '', icon_suffix = None):
+    import pygraphviz as pgv
+
     if icon_suffix is None:
         icon_suffix = format
     icon_suffix = '.' + icon_suffix
     G = pgv.AGraph(imagepath=icon_path + '/')
-    print(G.graph_attr)
     have_internet = []
     for net in networks:
         net_name = net.get('name', 'net')
@@ -17,10 +42,10 @@ def draw_setup(computers, networks, destination=None,
             have_internet.append(net_name)
         G.add_node('net-' + net_name, label=net_name, shape='rectangle')
     if len(have_internet):
-        G.add_node('net-' + 'internet', 
+        G.add_node('net-' + 'internet',
                    label='internet',
-                   labelloc='b', 
-                   image=icon_prefix + 'internet' + icon_suffix, 
+                   labelloc='b',
+                   image=icon_prefix + 'internet' + icon_suffix,
                    shape='none')
         for n in have_internet:
             G.add_edge('net-' + n, 'net-internet')
@@ -39,7 +64,140 @@ def draw_setup(computers, networks, destination=None,
             G.add_edge('comp-' + c, 'net-' + iface['network'])
     return G.draw(path=destination, format=format, prog='dot')
 
+def _text_width(s, size=14):
+    return int(len(str(s)) * size * 0.6) + 1
+
+def draw_setup_svg(computers, networks, icon_prefix, icon_suffix):
+    # Computers go in the top row in the given order, networks in the row
+    # below, each under the computers connected to it, and the internet (if
+    # any network is public) at the bottom.
+    pad, gap, font = 8, 30, 14
+    out = []
+
+    def image(name, x, y):
+        w, h = ICON_SIZES[name]
+        href = quoteattr(icon_prefix + name + icon_suffix)
+        out.append('<image x="{}" y="{}" width="{}" height="{}" xlink:href={} href={}/>'.format(
+            x, y, w, h, href, href))
+
+    def text(s, x, y, anchor='middle', bold=False):
+        out.append('<text x="{}" y="{}" text-anchor="{}"{}>{}</text>'.format(
+            x, y, anchor, ' font-weight="bold"' if bold else '', escape(str(s))))
+
+    # computers
+    comp_w, comp_h = ICON_SIZES['computer']
+    disk_w, disk_h = ICON_SIZES['drive-harddisk']
+    boxes = []
+    x = gap
+    for properties in computers:
+        name = properties.get('name', '')
+        disks = [hdd['name'] for hdd in properties.get('disks', [])]
+        w = max([comp_w, _text_width(name, font)] +
+                [disk_w + pad + _text_width(d, font) for d in disks]) + 2*pad
+        h = pad + font + pad + comp_h + len(disks) * (disk_h + pad) + pad
+        boxes.append((properties, name, disks, x, w, h))
+        x += w + gap
+    top = gap
+    comp_bottom = top + max([b[5] for b in boxes] + [0])
+
+    # networks, also those only mentioned by interfaces
+    net_list = [(net.get('name', 'net'), net.get('public', False)) for net in networks]
+    known = {n for n, public in net_list}
+    links = []
+    for properties, name, disks, x, w, h in boxes:
+        for iface in properties.get('network_interfaces', []):
+            if iface['network'] not in known:
+                known.add(iface['network'])
+                net_list.append((iface['network'], False))
+            links.append((x + w // 2, iface['network']))
+    centers = {}
+    for i, (net, public) in enumerate(net_list):
+        xs = [cx for cx, n in links if n == net]
+        centers[net] = (sum(xs) / len(xs) if xs else 0, i)
+    net_h = font + 4*pad
+    net_y = comp_bottom + 3*gap
+    net_pos = {}
+    right = 0
+    for net, public in sorted(net_list, key=lambda n: centers[n[0]]):
+        w = _text_width(net, font) + 4*pad
+        x = max(int(centers[net][0] - w / 2), right + gap)
+        net_pos[net] = (x, w, public)
+        right = x + w
+
+    # internet
+    public_nets = [net for net, public in net_list if public]
+    inet_w, inet_h = ICON_SIZES['internet']
+    if public_nets:
+        cx = sum(net_pos[n][0] + net_pos[n][1] / 2 for n in public_nets) / len(public_nets)
+        inet_x = max(int(cx - inet_w / 2), gap)
+        inet_y = net_y + net_h + 2*gap
+        bottom = inet_y + inet_h + pad + font
+    else:
+        bottom = net_y + net_h
+    width = max([right] + [b[3] + b[4] for b in boxes] +
+                ([inet_x + inet_w] if public_nets else [])) + gap
+    height = bottom + gap
+
+    out.append('<?xml version="1.0" encoding="UTF-8" standalone="no"?>')
+    out.append('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+               'width="{0}pt" height="{1}pt" viewBox="0 0 {0} {1}" '
+               'font-family="Times,serif" font-size="{2}">'.format(width, height, font))
+    out.append('<g stroke="black" fill="none">')
+    for cx, net in links:
+        x, w, public = net_pos[net]
+        out.append('<line x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(cx, comp_bottom, x + w // 2, net_y))
+    for net in public_nets:
+        x, w, public = net_pos[net]
+        out.append('<line x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(
+            x + w // 2, net_y + net_h, inet_x + inet_w // 2, inet_y))
+    for properties, name, disks, x, w, h in boxes:
+        out.append('<rect x="{}" y="{}" width="{}" height="{}"/>'.format(x, top, w, comp_bottom - top))
+    for net, (x, w, public) in net_pos.items():
+        out.append('<rect x="{}" y="{}" width="{}" height="{}"/>'.format(x, net_y, w, net_h))
+    out.append('</g>')
+
+    for properties, name, disks, x, w, h in boxes:
+        y = top + pad + font
+        text(name, x + w // 2, y, bold=True)
+        y += pad
+        image('computer', x + (w - comp_w) // 2, y)
+        y += comp_h
+        for d in disks:
+            image('drive-harddisk', x + pad, y)
+            text(d, x + pad + disk_w + pad, y + disk_h // 2 + font // 3, anchor='start')
+            y += disk_h + pad
+    for net, (x, w, public) in net_pos.items():
+        text(net, x + w // 2, net_y + net_h // 2 + font // 3)
+    if public_nets:
+        image('internet', inet_x, inet_y)
+        text('internet', inet_x + inet_w // 2, inet_y + inet_h + font)
+    out.append('</svg>')
+    return '\n'.join(out).encode('utf-8')
+
 if __name__ == '__main__':
-    import sample_task as task
-    print(draw_setup(task.computers, task.networks))
-    
+    # compare both renderers on typical task setups
+    import timeit
+
+    def setup(n_computers, n_networks):
+        networks = [{'name': 'net{}'.format(i), 'public': i == 0} for i in range(n_networks)]
+        computers = [{
+                'name': 'computer{}'.format(i),
+                'disks': [{'name': 'disk{}'.format(i)}],
+                'network_interfaces': [{'network': networks[j % n_networks]['name']} for j in range(i, i + 2)],
+            } for i in range(n_computers)]
+        return computers, networks
+
+    for n_computers, n_networks in [(1, 1), (2, 2), (4, 3)]:
+        computers, networks = setup(n_computers, n_networks)
+        print('{} computers, {} networks'.format(n_computers, n_networks))
+        for name, fn in [('native', draw_setup_svg), ('graphviz', draw_setup_graphviz)]:
+            if fn is draw_setup_svg:
+                run = lambda: draw_setup_svg(computers, networks, '../../../static/icons/', '.svg')
+            else:
+                run = lambda: draw_setup_graphviz(computers, networks, icon_path='static/icons')
+            try:
+                n = 100 if fn is draw_setup_svg else 10
+                t = timeit.timeit(run, number=n) / n
+                print('  {:<10} {:8.3f} ms'.format(name, t * 1000))
+            except ImportError as e:
+                print('  {:<10} unavailable ({})'.format(name, e))
@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Task instructions are Jinja templates. They are compiled once per version
+# through one environment with the same settings as jinja2.Template, and if
+# they only use the public params, the rendered text is cached per params.
+
+import hashlib
+import json
+import threading
+
+import jinja2
+import jinja2.meta
+from markupsafe import Markup
+
+from kpov_cache import TTLCache
+
+class _SourceLoader(jinja2.BaseLoader):
+    # template names include a hash of the source, so a name never changes
+    def __init__(self):
+        self.sources = {}
+
+    def get_source(self, environment, name):
+        try:
+            return self.sources[name], None, lambda: True
+        except KeyError:
+            raise jinja2.TemplateNotFound(name)
+
+class InstructionTemplates:
+    def __init__(self, bytecode_dir=None, cache_size=400, render_cache_size=4096, render_cache_ttl=3600):
+        self.loader = _SourceLoader()
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else None
+        self.env = jinja2.Environment(loader=self.loader, bytecode_cache=bytecode_cache, cache_size=cache_size)
+        self.rendered = TTLCache(render_cache_size, render_cache_ttl)
+        # template name -> names the template reads from its context
+        self._variables = {}
+        # (course_id, task_id, lang) -> name of the current version, so the
+        # source of a replaced version is dropped instead of kept forever
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def get(self, course_id, task_id, lang, source):
+        key = (course_id, task_id, lang)
+        name = '{}/{}/{}/{}'.format(course_id, task_id, lang, hashlib.sha256(source.encode()).hexdigest())
+        with self._lock:
+            old = self._names.get(key)
+            if old != name:
+                if old is not None:
+                    del self.loader.sources[old]
+                    del self._variables[old]
+                self._names[key] = name
+                self.loader.sources[name] = source
+                self._variables[name] = jinja2.meta.find_undeclared_variables(self.env.parse(source))
+            return self.env.get_template(name)
+
+    def render(self, template, params):
+        # the rendered template as Markup, or None if it uses anything besides
+        # params, in which case it has to be included in the page
+        variables = self._variables.get(template.name)
+        # a version replaced since get is rendered with the page
+        if variables is None or not variables <= set(params) | set(self.env.globals):
+            return None
+        used = {k: v for k, v in params.items() if k in variables}
+        key = (template.name, json.dumps(used, sort_keys=True, default=str))
+        text = self.rendered.get(key)
+        if text is None:
+            text = template.render(**used)
+            self.rendered.set(key, text)
+        return Markup(text)
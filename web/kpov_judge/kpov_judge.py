@@ -2,26 +2,127 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import collections
+import copy
 import datetime
+import hashlib
+import ipaddress
 import json
+import os
 import random
 import settings
+import threading
+import time
 import traceback
 import uuid
 
+from kpov_cache import TTLCache
 from kpov_draw_setup import draw_setup
+from kpov_instructions import InstructionTemplates
+import kpov_metrics as metrics
+from kpov_record import TrafficRecorder
+from kpov_trace import JsonLinesExporter, Tracer
 import kpov_util
+import result_storage
 
 import pymongo
+import pymongo.monitoring
 import flask
-from flask import Flask, g, session, redirect, url_for, abort, render_template, flash, app, request, Response
+from flask import Flask, g, session, redirect, url_for, abort, render_template, flash, app, request, Response, send_file
 from flask_babel import Babel, gettext, ngettext, format_datetime, _
-import jinja2
+from werkzeug.wsgi import FileWrapper
 
 app = Flask(__name__)
 app.config.from_object(settings)
 babel = Babel(app)
 
+# (score, hints) for checks already done on the same checker, params and results
+check_cache = TTLCache(app.config.get('CHECK_CACHE_SIZE', 0), app.config.get('CHECK_CACHE_TTL', 300))
+# task_params records by (course_id, task_id, token), off by default. The
+# cache is per process: a token rotated in another process, or params changed
+# by add_task, are still served from here for up to TOKEN_CACHE_TTL seconds.
+token_cache = TTLCache(app.config.get('TOKEN_CACHE_SIZE', 0), app.config.get('TOKEN_CACHE_TTL', 60))
+
+# export a sample of the request traces, and all slow ones; TRACE_EXPORTER
+# may be any object with an export(trace) method
+tracer = Tracer(app.config.get('TRACE_EXPORTER') or JsonLinesExporter(app.config.get('TRACE_PATH', 'traces.jsonl')),
+                sample_rate=app.config.get('TRACE_SAMPLE_RATE', 0.0),
+                slow_seconds=app.config.get('TRACE_SLOW_SECONDS'))
+
+instruction_templates = InstructionTemplates(
+    bytecode_dir=app.config.get('INSTRUCTIONS_BYTECODE_DIR'),
+    render_cache_size=app.config.get('INSTRUCTIONS_CACHE_SIZE', 4096),
+    render_cache_ttl=app.config.get('INSTRUCTIONS_CACHE_TTL', 3600))
+
+# anonymized params.json and results.json traffic for replay_traffic.py
+recorder = None
+if app.config.get('TRAFFIC_RECORD_PATH'):
+    recorder = TrafficRecorder(app.config['TRAFFIC_RECORD_PATH'], app.config.get('TRAFFIC_RECORD_SALT', ''))
+
+REQUEST_TIME = metrics.Histogram('kpov_request_seconds',
+    'Time spent handling a request.', ['route', 'method', 'status'])
+MONGO_TIME = metrics.Histogram('kpov_mongo_command_seconds',
+    'Duration of MongoDB commands.', ['command'])
+MONGO_REQUEST_COMMANDS = metrics.Histogram('kpov_mongo_commands_per_request',
+    'Number of MongoDB commands run by a request.', ['route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+MONGO_REQUEST_TIME = metrics.Histogram('kpov_mongo_seconds_per_request',
+    'Time a request spent waiting for MongoDB.', ['route'])
+CHECK_TIME = metrics.Histogram('kpov_check_seconds',
+    'Time spent compiling and running task_check.', ['course_id', 'task_id'])
+GEN_PARAMS_TIME = metrics.Histogram('kpov_gen_params_seconds',
+    'Time spent compiling and running gen_params.', ['course_id', 'task_id'])
+DRAW_SETUP_TIME = metrics.Histogram('kpov_draw_setup_seconds',
+    'Time spent drawing setup diagrams.', ['format'])
+ERRORS = metrics.Counter('kpov_errors_total',
+    'Errors: unhandled exceptions in requests, crashed checkers and parameter generators, failed MongoDB commands.', ['kind'])
+
+
+def cache_stat(field):
+    caches = [('token', token_cache), ('check', check_cache)]
+    return lambda: {(name, ): cache.stats()[field] for name, cache in caches}
+
+metrics.Gauge('kpov_cache_hits_total', 'Hits of the in-process caches.', ['cache'], cache_stat('hits'), kind='counter')
+metrics.Gauge('kpov_cache_misses_total', 'Misses of the in-process caches.', ['cache'], cache_stat('misses'), kind='counter')
+metrics.Gauge('kpov_cache_size', 'Entries in the in-process caches.', ['cache'], cache_stat('size'))
+
+
+class MongoMetrics(pymongo.monitoring.CommandListener):
+    # command events are published in the thread running the command, so
+    # commands can be counted for the request served by that thread
+    local = threading.local()
+
+    def started(self, event):
+        if tracer.active:
+            # the collection is only known when the command starts
+            collections = getattr(self.local, 'collections', None)
+            if collections is None:
+                collections = self.local.collections = {}
+            collections[event.request_id] = event.command.get(event.command_name)
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        ERRORS.inc('mongo')
+        self.record(event, error=True)
+
+    def record(self, event, error=False):
+        seconds = event.duration_micros / 1e6
+        MONGO_TIME.observe(seconds, event.command_name)
+        collections = getattr(self.local, 'collections', None)
+        if collections:
+            collection = collections.pop(event.request_id, None)
+            attrs = {'collection': str(collection)}
+            if error:
+                attrs['error'] = True
+            tracer.add_span('mongo ' + event.command_name, seconds, **attrs)
+        stats = getattr(self.local, 'stats', None)
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += seconds
+
+mongo_metrics = MongoMetrics()
+pymongo.monitoring.register(mongo_metrics)
+
 def get_locale():
     # terrible hack, should store as user preference in the DB
     if '/en/' in request.path:
@@ -33,9 +134,59 @@ def get_locale():
 
 @app.before_request
 def before_request():
+    g.start_time = time.perf_counter()
+    tracer.start_trace(request.path, method=request.method)
+    mongo_metrics.local.stats = [0, 0.0]
     g.db = pymongo.MongoClient(app.config['DB_URI']).get_default_database()
 
 
+def observe_request(status):
+    if g.get('observed') or 'start_time' not in g:
+        return
+    g.observed = True
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    REQUEST_TIME.observe(time.perf_counter() - g.start_time, route, request.method, status)
+    stats = mongo_metrics.local.stats
+    if stats is not None:
+        MONGO_REQUEST_COMMANDS.observe(stats[0], route)
+        MONGO_REQUEST_TIME.observe(stats[1], route)
+    mongo_metrics.local.stats = None
+    mongo_metrics.local.collections = None
+    tracer.finish_trace(route=route, status=status)
+
+
+@app.after_request
+def after_request(response):
+    observe_request(str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def teardown_request(exc):
+    # after_request is skipped for unhandled exceptions
+    if exc is not None:
+        ERRORS.inc('request')
+    observe_request('500')
+
+
+# clients allowed to read /metrics and /cache_stats.json, as addresses or networks
+stats_allow = [ipaddress.ip_network(n, strict=False) for n in app.config.get('STATS_ALLOW', ['127.0.0.1', '::1'])]
+
+def check_stats_allowed():
+    try:
+        addr = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        abort(403)
+    if not any(addr in net for net in stats_allow):
+        abort(403)
+
+
+@app.route('/metrics')
+def metrics_text():
+    check_stats_allowed()
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/')
 @app.route('/courses/')
 def index():
@@ -65,23 +216,30 @@ def setup_svg(course_id, task_id, lang, ending):
     }[ending]
     networks = list(db.networks.find({'course_id': course_id, 'task_id': task_id}))
     computers = list(db.computers_meta.find({'course_id': course_id, 'task_id': task_id}))
-    return Response(draw_setup(computers, networks, format=fmt,
-                          icon_path=app.config['STATIC_DIR']),
-                    mimetype=mimetype)
+    with DRAW_SETUP_TIME.time(fmt):
+        image = draw_setup(computers, networks, format=fmt,
+                           icon_path=app.config['STATIC_DIR'])
+    return Response(image, mimetype=mimetype)
 
 
-@app.route('/tasks/<course_id>/<task_id>/task.py')
-def task_source(course_id, task_id):
-    db = g.db
+def get_task_source(course_id, task_id, db):
     try:
         return db.tasks.find_one({'course_id': course_id, 'task_id': task_id})['source']
     except:
         return ''
 
 
+@app.route('/tasks/<course_id>/<task_id>/task.py')
+def task_source(course_id, task_id):
+    # let test_task.py revalidate its cached copy with If-None-Match
+    response = Response(get_task_source(course_id, task_id, g.db), mimetype='text/x-python')
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 @app.route('/tasks/<course_id>/<task_id>/task.html')
 def task_html(course_id, task_id):
-    return render_template('task.html', task=task_source(course_id, task_id))
+    return render_template('task.html', task=get_task_source(course_id, task_id, g.db))
 
 
 def get_params(course_id, task_id, student_id, db):
@@ -94,10 +252,11 @@ def get_params(course_id, task_id, student_id, db):
     if params is None or 'params' not in params: # TODO try with $exists: params or smth.
         try:
             gen_params_source = db.gen_params.find_one({'course_id': course_id, 'task_id': task_id})['source']
-            gen_params_code = compile(gen_params_source, 'generator.py', 'exec')
-            d = {}
-            exec(gen_params_code, globals(), d)
-            params = d['gen_params'](student_id, meta)
+            with GEN_PARAMS_TIME.time(course_id, task_id):
+                gen_params_code = compile(gen_params_source, 'generator.py', 'exec')
+                d = {}
+                exec(gen_params_code, globals(), d)
+                params = d['gen_params'](student_id, meta)
             db.task_params.update({'course_id': course_id, 'task_id': task_id, 'student_id': student_id},
                 {'$set': {'params': params}}, upsert=True)
             params = d['gen_params'](student_id, meta) # TODO this is repeated, is it necessary?
@@ -111,6 +270,7 @@ def get_params(course_id, task_id, student_id, db):
                 db.student_computers.update({'course_id': course_id, 'task_id': task_id, 'student_id': student_id, 'name': name},
                     {'$set': computer}, upsert=True)
         except Exception as e:
+            ERRORS.inc('gen_params')
             meta = {'crash': {'public': True}}
             params = {'crash': "Parameter creator crashed or missing:\n{}".format(
                 traceback.format_exc())}
@@ -165,15 +325,31 @@ def task_greeting(course_id, task_id, lang):
         except Exception as e:
             instructions = str(e)
 
+    template = instruction_templates.get(course_id, task_id, lang, instructions)
+    with tracer.span('render instructions'):
+        rendered = instruction_templates.render(template, {p['name']: p['value'] for p in public_params})
+
     computer_list = list(db.student_computers.find({'course_id': course_id, 'task_id': task_id, 'student_id': student_id}))
 
     backing_files = collections.defaultdict(set)
+    checksums = {}
     for computer in computer_list:
         if 'disk_urls' not in computer:
             continue
         for name, disk in computer['disk_urls'].items():
+            for fmt, digests in disk.get('sha256', {}).items():
+                checksums.update(zip(disk[fmt], digests))
+            # offer the compressed variant when it is smaller than the image
+            # with its backing files
+            disk['download'] = {}
             for fmt in disk['formats']:
-                backing_files[fmt] |= set(disk[fmt][1:])
+                export = disk.get('exports', {}).get(fmt)
+                if export and export['ratio'] < 1:
+                    disk['download'][fmt] = export['file']
+                    checksums[export['file']] = export['sha256']
+                else:
+                    disk['download'][fmt] = disk[fmt][0]
+                    backing_files[fmt] |= set(disk[fmt][1:])
 
     if request.args.get('narediStack', 'false') == 'true':
       #db.student_tasks.update({'task_id': task_id, 'student_id': student_id}, {'$set': {'create_openstack': True}}, upsert = True)
@@ -188,26 +364,159 @@ def task_greeting(course_id, task_id, lang):
 
     try:
         result = db.results.find_one(
-            {'$query': {'course_id': course_id, 'task_id': task_id, 'student_id': student_id},
+            {'$query': {'course_id': course_id, 'task_id': task_id, 'student_id': student_id,
+                        'superseded_by': {'$exists': False}},
                 '$orderby': collections.OrderedDict([('result', -1), ('time', 1)])},
-            {'result': 1, 'status': 1, 'hints': 1, 'time': True, '_id': 0})
+            dict({'result': 1, 'status': 1, 'hints': 1, 'time': True, '_id': 0}, **result_storage.PACKED_PROJECTION))
+        result = result_storage.unpack(result)
         result['time'] = format_datetime(result['time'])
         print(result)
     except Exception:
         result = None
 
-    return render_template('task_greeting.html',
-        disk_base_url='/'.join([app.config['STUDENT_DISK_URL'], student_id, course_id, task_id, '']),
-        course_id=course_id,
-        task_id=task_id,
-        computers=sorted((c for c in computer_list if 'disk_urls' in c), key=lambda c: c['name']),
-        backing_files={fmt: sorted(images) for fmt, images in backing_files.items()},
-        lang='sl' if lang == 'si' else lang, # TODO s/si/sl in all tasks (and maybe elsewhere)
-        openstack=openstackCreated,
-        instructions=jinja2.Template(instructions),
-        params=public_params,
-        result=result,
-        **{p['name']: p['value'] for p in public_params})
+    with tracer.span('render task_greeting.html'):
+        return render_template('task_greeting.html',
+            disk_base_url='../disks/' if app.config.get('SERVE_STUDENT_DISKS') else
+                '/'.join([app.config['STUDENT_DISK_URL'], student_id, course_id, task_id, '']),
+            course_id=course_id,
+            task_id=task_id,
+            computers=sorted((c for c in computer_list if 'disk_urls' in c), key=lambda c: c['name']),
+            backing_files={fmt: sorted(images) for fmt, images in backing_files.items()},
+            checksums=checksums,
+            lang='sl' if lang == 'si' else lang, # TODO s/si/sl in all tasks (and maybe elsewhere)
+            openstack=openstackCreated,
+            instructions=template,
+            rendered_instructions=rendered,
+            params=public_params,
+            result=result,
+            **{p['name']: p['value'] for p in public_params})
+
+
+# number of disk downloads in progress for each student in this process
+active_downloads = collections.Counter()
+active_downloads_lock = threading.Lock()
+
+
+class DownloadFile:
+    # the file handed to the server's wsgi.file_wrapper, which closes it when
+    # the download ends or is aborted; other methods (read, fileno for
+    # sendfile …) go to the real file
+    def __init__(self, f, on_close):
+        self._file = f
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            self._on_close()
+
+
+@app.route('/tasks/<course_id>/<task_id>/disks/<fname>')
+def student_disk(course_id, task_id, fname):
+    student_id = flask.app.request.environ.get('REMOTE_USER', 'Nobody')
+    db = g.db
+    # only files listed for this student's computers can be downloaded
+    snapshots = set()
+    backing = set()
+    for computer in db.student_computers.find(
+            {'course_id': course_id, 'task_id': task_id, 'student_id': student_id, 'disk_urls': {'$exists': True}},
+            {'disk_urls': 1}):
+        for disk in computer['disk_urls'].values():
+            for fmt in disk['formats']:
+                snapshots.add(disk[fmt][0])
+                backing.update(disk[fmt][1:])
+            snapshots.update(export['file'] for export in disk.get('exports', {}).values())
+    if fname not in snapshots and fname not in backing:
+        abort(404)
+    path = os.path.join(app.config['STUDENT_DISK_PATH'], student_id, course_id, task_id, fname)
+    if os.path.basename(fname) != fname or not os.path.isfile(path):
+        abort(404)
+
+    with active_downloads_lock:
+        if active_downloads[student_id] >= app.config.get('STUDENT_DISK_DOWNLOADS', 4):
+            response = Response('too many downloads in progress\n', status=429, mimetype='text/plain')
+            response.headers['Retry-After'] = '30'
+            return response
+        active_downloads[student_id] += 1
+
+    done = []
+    def finished():
+        with active_downloads_lock:
+            if done:
+                return
+            done.append(True)
+            active_downloads[student_id] -= 1
+            if active_downloads[student_id] <= 0:
+                del active_downloads[student_id]
+
+    # the response is passed through to the server and never closed, so the
+    # download is counted until the server closes the file
+    files = []
+    environ = request.environ
+    server_file_wrapper = environ.get('wsgi.file_wrapper')
+    def file_wrapper(f, buffer_size=8192):
+        files.append(DownloadFile(f, finished))
+        return (server_file_wrapper or FileWrapper)(files[-1], buffer_size)
+
+    try:
+        # Range, If-Range and If-None-Match are handled by send_file; the file
+        # is passed to the server's wsgi.file_wrapper (or X-Sendfile with
+        # USE_X_SENDFILE) so it can use sendfile. Backing files are shared by
+        # many tasks and never change, so they can be cached for long.
+        max_age = None if fname in snapshots else app.config.get('BACKING_FILE_MAX_AGE', 30*24*3600)
+        # only while send_file runs: servers compare the response with
+        # their own wsgi.file_wrapper to decide whether to use sendfile
+        environ['wsgi.file_wrapper'] = file_wrapper
+        try:
+            response = send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                                 conditional=True, etag=True, max_age=max_age)
+        finally:
+            if server_file_wrapper is None:
+                del environ['wsgi.file_wrapper']
+            else:
+                environ['wsgi.file_wrapper'] = server_file_wrapper
+        if max_age is None:
+            response.cache_control.private = True
+        else:
+            response.cache_control.immutable = True
+        if response.response is None or isinstance(response.response, (list, tuple)):
+            # nothing is sent from the file (X-Sendfile, 304 …)
+            for f in files:
+                f.close()
+            finished()
+    except Exception:
+        for f in files:
+            f.close()
+        finished()
+        raise
+    return response
+
+
+@app.route('/tasks/<course_id>/<task_id>/disks/SHA256SUMS', methods=['GET', 'POST'])
+def disk_checksums(course_id, task_id):
+    db = g.db
+    if request.method == 'POST':
+        # test_task.py identifies the student with the task token
+        record = find_token(course_id, task_id, request.form.get('token', ''), db)
+        if not record:
+            abort(404)
+        student_id = record['student_id']
+    else:
+        student_id = flask.app.request.environ.get('REMOTE_USER', 'Nobody')
+    # in the format of sha256sum, so images can be checked with sha256sum -c
+    lines = set()
+    for computer in db.student_computers.find(
+            {'course_id': course_id, 'task_id': task_id, 'student_id': student_id, 'disk_urls': {'$exists': True}},
+            {'disk_urls': 1}):
+        for disk in computer['disk_urls'].values():
+            for fmt, digests in disk.get('sha256', {}).items():
+                lines.update('{}  {}\n'.format(digest, fname) for fname, digest in zip(disk[fmt], digests))
+            lines.update('{}  {}\n'.format(export['sha256'], export['file']) for export in disk.get('exports', {}).values())
+    return Response(''.join(sorted(lines, key=lambda line: line[66:])), mimetype='text/plain')
 
 
 @app.route('/tasks/<course_id>/<task_id>/token.json')
@@ -215,16 +524,39 @@ def get_token(course_id, task_id):
     db = g.db
     student_id = flask.app.request.environ.get('REMOTE_USER', 'Nobody')
     token = str(uuid.uuid4())
-    db.task_params.update({'course_id': course_id, 'task_id': task_id, 'student_id': student_id},
-                {'$set': {'token': token}}, upsert=True)
+    old = db.task_params.find_one_and_update({'course_id': course_id, 'task_id': task_id, 'student_id': student_id},
+                {'$set': {'token': token}}, {'token': 1}, upsert=True)
+    if old and 'token' in old:
+        token_cache.pop((course_id, task_id, old['token']))
     return json.dumps({'token': token})
 
 
+def find_token(course_id, task_id, token, db):
+    key = (course_id, task_id, token)
+    record = token_cache.get(key)
+    if record is None:
+        record = db.task_params.find_one({'course_id': course_id, 'task_id': task_id, 'token': token},
+                                         {'course_id': 1, 'task_id': 1, 'student_id': 1, 'params': 1})
+        # records without params change on the next visit, so are not kept
+        if record and record.get('params') is not None:
+            token_cache.set(key, record)
+    if record is None:
+        return None
+    # callers modify params
+    return copy.deepcopy(record)
+
+
+@app.route('/cache_stats.json')
+def cache_stats():
+    check_stats_allowed()
+    return json.dumps({'token': token_cache.stats(), 'check': check_cache.stats()})
+
+
 @app.route('/tasks/<course_id>/<task_id>/params.json', methods=['POST'])
 def params_json(course_id, task_id):
     db = g.db
     token = flask.app.request.form['token']
-    record = db.task_params.find_one({'course_id': course_id, 'task_id': task_id, 'token': token})
+    record = find_token(course_id, task_id, token, db)
     if not record:
         return json.dumps({})
     params, meta = get_params(record['course_id'], record['task_id'], record['student_id'], db)
@@ -232,42 +564,78 @@ def params_json(course_id, task_id):
     for name, param in params.items():
         if meta.get(name, {'public': False})['public']:
             shown_params[name] = param
+    if recorder:
+        recorder.record('params', course_id=course_id, task_id=task_id,
+                        student_id=recorder.anonymize(record['student_id']), token=recorder.anonymize(token),
+                        response=shown_params)
     return json.dumps(shown_params)
 
 
+def check_key(task_check_source, params, results):
+    # identical checker source, params and results give the same check
+    h = hashlib.sha256(task_check_source.encode())
+    h.update(json.dumps([params, results], sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
 @app.route('/tasks/<course_id>/<task_id>/results.json', methods=['POST'])
 def results_json(course_id, task_id):
     db = g.db
     token = flask.app.request.form.get('token', '')
-    task = db.task_params.find_one({'course_id': course_id, 'task_id': task_id, 'token': token})
+    with tracer.span('token lookup'):
+        task = find_token(course_id, task_id, token, db)
     if not task:
         return json.dumps({'result': 0, 'hints': ['invalid token'], 'status': 'NOT OK'})
 
-    params = task['params']
+    params = task.get('params')
     if params is None:
         return json.dumps({'result': 0, 'hints': ['no parameters found for task'], 'status': 'NOT OK'}) # no such task
 
     results = json.loads(flask.app.request.form['results'])
     user_params = json.loads(flask.app.request.form['params'])
+    stored_params = dict(params)
 
-    meta = db.task_params_meta.find_one({'task_id': task_id})
+    with tracer.span('meta fetch'):
+        meta = db.task_params_meta.find_one({'task_id': task_id})
     if meta is None:
         meta = {}
     else:
         meta = meta['params']
+    # writable params sent by the student are stored with the result, so it
+    # can be regraded
+    written_params = {}
     for param_name, param_meta in meta.items():
         if param_meta.get('w', False) and param_name in user_params:
-            params[param_name] = user_params[param_name]
+            params[param_name] = written_params[param_name] = user_params[param_name]
 
     # hack to get token into task_check function
     # TODO rethink the API
     params['token'] = token
+    memoized = False
+    task_check_source = None
     try:
-        task_check_source = db.task_checkers.find_one({'course_id': course_id, 'task_id': task_id})['source']
-        d = {}
-        exec(compile(task_check_source, 'checker.py', 'exec'), globals(), d)
-        res, hints = d['task_check'](collections.defaultdict(str, results), params)
+        with tracer.span('checker fetch'):
+            checker = db.task_checkers.find_one({'course_id': course_id, 'task_id': task_id})
+        task_check_source = checker['source']
+        # tasks with non-deterministic checkers set memoize_checks = False
+        key = None
+        if check_cache.maxsize > 0 and checker.get('memoize', True):
+            key = check_key(task_check_source, params, results)
+            cached = check_cache.get(key)
+            if cached is not None:
+                res, hints = cached[0], list(cached[1])
+                memoized = True
+        if not memoized:
+            with CHECK_TIME.time(course_id, task_id):
+                with tracer.span('checker compile'):
+                    d = {}
+                    exec(compile(task_check_source, 'checker.py', 'exec'), globals(), d)
+                with tracer.span('checker run'):
+                    res, hints = d['task_check'](collections.defaultdict(str, results), params)
+            if key is not None:
+                check_cache.set(key, (res, list(hints)))
     except Exception as e:
+        ERRORS.inc('checker')
         hints = ["Checker died: " + str(e)]
         res = 0
     if (isinstance(res, int) or isinstance(res, float)) and res > 0:
@@ -275,13 +643,24 @@ def results_json(course_id, task_id):
     else:
         res_status = 'NOT OK'
 
-    db.results.insert({
+    record = {
         'course_id': course_id, 'task_id': task_id,
         'result': res, 'hints': hints, 'status': res_status,
         'student_id': task['student_id'],
         'response': results,
+        'user_params': written_params,
         'time': datetime.datetime.now()
-    })
+    }
+    if memoized:
+        record['memoized'] = True
+    with tracer.span('results insert', memoized=memoized):
+        db.results.insert(result_storage.pack(record, app.config.get('RESULTS_COMPRESSION')))
+    if recorder and task_check_source is not None:
+        recorder.record('results', course_id=course_id, task_id=task_id,
+                        student_id=recorder.anonymize(task['student_id']), token=recorder.anonymize(token),
+                        params=stored_params, results=results, user_params=user_params,
+                        checker=recorder.record_task(course_id, task_id, task_check_source, meta),
+                        response={'result': res, 'hints': hints, 'status': res_status})
     return json.dumps({'result': res, 'hints': hints, 'status': res_status})
 
 
@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Minimal counters and histograms rendered in the Prometheus text format.
+# The metrics live in the memory of each server process, so with several
+# worker processes /metrics shows only the process that answered; scrape each
+# worker separately or run a single process if the totals matter.
+
+import bisect
+import collections
+import threading
+import time
+
+# seconds
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+def _number(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, v in sorted(values.items()):
+            yield self.name, _labels(self.labels, labels), v
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels: [count per bucket..., count above last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [0] * (len(self.buckets) + 2)
+            v[i] += 1
+            v[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for labels, v in sorted(values.items()):
+            total = 0
+            for le, n in zip(self.buckets + (float('inf'),), v):
+                total += n
+                yield self.name + '_bucket', _labels(self.labels, labels, [('le', _number(le))]), total
+            yield self.name + '_sum', _labels(self.labels, labels), v[-1]
+            yield self.name + '_count', _labels(self.labels, labels), total
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Gauge:
+    # value read from a function when the metrics are rendered; the function
+    # returns {label values: value}. Counters kept elsewhere are exported
+    # with kind='counter'.
+    def __init__(self, name, doc, labels, collect, kind='gauge'):
+        self.kind = kind
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.collect = collect
+        _metrics.append(self)
+
+    def samples(self):
+        for labels, v in sorted(self.collect().items()):
+            yield self.name, _labels(self.labels, labels), v
+
+def render():
+    lines = []
+    for m in _metrics:
+        lines.append('# HELP {} {}'.format(m.name, m.doc))
+        lines.append('# TYPE {} {}'.format(m.name, m.kind))
+        for name, labels, value in m.samples():
+            lines.append('{}{} {}'.format(name, labels, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
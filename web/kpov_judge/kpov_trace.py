@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Per-request traces: a trace is a list of timed spans, possibly nested, for
+# one request. Finished traces are given to an exporter, which is any object
+# with an export(trace) method; trace is a JSON-serializable dict.
+
+import json
+import random
+import threading
+import time
+import uuid
+
+class JsonLinesExporter:
+    # append each trace as one line of JSON
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace, default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+class _Trace:
+    def __init__(self, name, attrs):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.stack = []
+
+class _Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        trace = self.trace
+        self.index = len(trace.spans)
+        trace.spans.append({
+            'name': self.name,
+            'parent': trace.stack[-1] if trace.stack else None,
+            'start': time.perf_counter() - trace.start,
+            'attrs': self.attrs,
+        })
+        trace.stack.append(self.index)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        span = trace.spans[self.index]
+        span['duration'] = time.perf_counter() - trace.start - span['start']
+        if exc_type is not None:
+            span['error'] = repr(exc)
+        trace.stack.pop()
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_no_span = _NoSpan()
+
+class Tracer:
+    # A fraction sample_rate of the traces is exported. With slow_seconds
+    # set, traces of requests taking at least that long are exported as well,
+    # so sample_rate=0 captures only slow requests.
+    def __init__(self, exporter, sample_rate=0.0, slow_seconds=None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.exporter is not None and (self.sample_rate > 0 or self.slow_seconds is not None)
+
+    @property
+    def active(self):
+        # whether the current thread is recording a trace
+        return getattr(self.local, 'trace', None) is not None
+
+    def start_trace(self, name, **attrs):
+        self.local.trace = None
+        if not self.enabled:
+            return
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_seconds is None:
+            return
+        trace = _Trace(name, attrs)
+        trace.sampled = sampled
+        self.local.trace = trace
+
+    def span(self, name, **attrs):
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return _no_span
+        return _Span(trace, name, attrs)
+
+    def add_span(self, name, duration, **attrs):
+        # a span that has just ended, e.g. reported by a callback
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return
+        end = time.perf_counter() - trace.start
+        trace.spans.append({
+            'name': name,
+            'parent': trace.stack[-1] if trace.stack else None,
+            'start': end - duration,
+            'duration': duration,
+            'attrs': attrs,
+        })
+
+    def finish_trace(self, **attrs):
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        if trace is None:
+            return
+        duration = time.perf_counter() - trace.start
+        if not trace.sampled and duration < self.slow_seconds:
+            return
+        trace.attrs.update(attrs)
+        try:
+            self.exporter.export({
+                'trace_id': trace.id,
+                'name': trace.name,
+                'time': trace.wall_start,
+                'duration': duration,
+                'attrs': trace.attrs,
+                'spans': trace.spans,
+            })
+        except Exception:
+            # tracing must never break a request
+            pass
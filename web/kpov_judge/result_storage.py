@@ -0,0 +1 @@
+../../result_storage.py
\ No newline at end of file